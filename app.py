@@ -1,21 +1,33 @@
 import json
 import logging
-import sqlite3
 import sys
 import uuid
 from pathlib import Path
 
-from flask import Flask, current_app, redirect, render_template, url_for
+from flask import Flask, current_app, redirect, render_template, session, url_for
 from flask_login import LoginManager, current_user, login_required, logout_user
 from flask_login.signals import user_logged_in
-from xrpl.clients import JsonRpcClient, WebsocketClient
+from xrpl.clients import JsonRpcClient
 from xrpl.wallet import Wallet
 
+from flask_nft_xumm import db, shared_cache
+from flask_nft_xumm.bithomp import BithompClient
+from flask_nft_xumm.cache import TTLCache
+from flask_nft_xumm.ledger import CoalescingClient
+from flask_nft_xumm.listing import NFTListing
 from flask_nft_xumm.login import XUMMUser, login
+from flask_nft_xumm.migrations import migrate
+from flask_nft_xumm.mirror import start_ledger_mirror
+from flask_nft_xumm.pool import LedgerClientPool
+from flask_nft_xumm.prefetch import PREFETCH_WORKERS, WalletPrefetcher
+from flask_nft_xumm.reconcile import start_stock_reconciler
+from flask_nft_xumm.settlement import start_settlement_queue
+from flask_nft_xumm.signer import MarketplaceSigner
+from flask_nft_xumm.transactions import ValidationWatcher
 
 
 def nft_factory(**kwargs):
-    return kwargs
+    return NFTListing(**kwargs)
 
 
 def create_app():
@@ -27,23 +39,68 @@ def create_app():
     app.secret_key = str(uuid.uuid1())
     app.creds = json.loads(Path("creds.json").read_text())
     app.config.ledger_url = app.creds["ledger"]
-    app.xrpl_client = WebsocketClient(app.config.ledger_url)
+    app.config.ledger_urls = app.creds.get("ledgers", [app.config.ledger_url])
+    app.xrpl_client = CoalescingClient(
+        LedgerClientPool(
+            app.config.ledger_urls,
+            size=app.creds.get("ledger_connections", 2),
+            timeout=app.creds.get("ledger_timeout", 10),
+        )
+    )
     app.nft_factory = nft_factory
+    app.use_x_sendfile = app.creds.get("media", {}).get("x_sendfile", False)
+    migrate(db.connection())
+    shared_cache.configure(shared_cache.backend_from_config(app.creds.get("cache")))
+    app.bithomp = None
+    if app.creds.get("bithomp"):
+        app.bithomp = BithompClient(
+            app.creds["bithomp_url"],
+            app.creds["bithomp"],
+            pool_size=app.creds.get("bithomp_connections", 10),
+        )
+    app.ledger_mirror = None
+    if app.creds.get("ledger_mirror"):
+        app.ledger_mirror = start_ledger_mirror(app)
+    app.stock_reconciler = None
+    if app.creds.get("reconcile_interval"):
+        app.stock_reconciler = start_stock_reconciler(
+            app, app.creds["reconcile_interval"]
+        )
 
     from flask_nft_xumm.detail import detail as detail_blueprint
     from flask_nft_xumm.nft import nft as nft_blueprint
     from flask_nft_xumm.trade import trade as trade_blueprint
     from flask_nft_xumm.wallet import wallet as wallet_blueprint
+    from flask_nft_xumm.webhook import webhook as webhook_blueprint
 
     app.register_blueprint(detail_blueprint)
     app.register_blueprint(trade_blueprint)
     app.register_blueprint(wallet_blueprint)
+    app.register_blueprint(webhook_blueprint)
     app.register_blueprint(login, url_prefix="/login")
     app.register_blueprint(nft_blueprint, url_prefix="/nft")
 
     app.marketplace_wallet = Wallet(
         seed=app.creds["secret"], sequence=app.creds["sequence"]
     )
+    app.marketplace_signer = MarketplaceSigner(
+        app.marketplace_wallet,
+        app.xrpl_client,
+        tickets=app.creds.get("tickets", 0),
+        logger=app.logger.getChild("signer"),
+    )
+    app.settlement_queue = start_settlement_queue(app)
+    app.validation_watcher = ValidationWatcher(app)
+    workers = app.creds.get("prefetch_workers", PREFETCH_WORKERS)
+    app.wallet_prefetcher = WalletPrefetcher(app, workers) if workers else None
+
+    @app.before_request
+    def start_background_threads():
+        # Forked workers (e.g. gunicorn --preload) start their own
+        for worker in (app.ledger_mirror, app.stock_reconciler, app.settlement_queue):
+            if worker is not None:
+                worker.ensure_running(app)
+
     return app
 
 
@@ -63,26 +120,38 @@ login_manager.session_protection = "strong"
 
 def wallet_cache_put(key, value):
     current_app.logger.debug(f"wallet_cache_put: {key}: {value}")
-    con = sqlite3.connect("xumm.db")
-    with con:
-        sql = "insert into wallet_cache (user_token, wallet_address) values (:user_token, :wallet_address)"
-        sql += "ON CONFLICT(user_token) DO UPDATE SET wallet_address=:wallet_address"
-        con.execute(sql, {"user_token": key, "wallet_address": value})
-    con.close()
+    db.wallet_cache_put(key, value)
 
 
 def wallet_cache_get(key):
     logger = current_app.logger.getChild("wallet_cache")
     logger.debug(f"{key}")
-    con = sqlite3.connect("xumm.db")
-    cur = con.cursor()
-    sql = "select wallet_address from wallet_cache where user_token = ?"
-    result = cur.execute(sql, [key]).fetchone()
-    con.close()
+    result = db.wallet_cache_get(key)
     logger.debug(f"result: {result}")
     if not result:
         raise KeyError(f"{key} not found in cache")
-    return result[0]
+    return result
+
+
+# The wallet address each user token belongs to, which never changes. Unless
+# `"session_wallet"` is false in creds.json, it's kept in the (signed) session
+# as well, so loading the user for a request doesn't touch the database;
+# this covers sessions without it, e.g. after a remember me login.
+user_wallets = TTLCache(maxsize=4096, ttl=24 * 60 * 60)
+SESSION_WALLET = "xumm_wallet"
+
+
+def remember_wallet(user_token, address):
+    user_wallets.set(user_token, address)
+    if current_app.creds.get("session_wallet", True):
+        session[SESSION_WALLET] = [user_token, address]
+
+
+def session_wallet(user_token):
+    stored = session.get(SESSION_WALLET)
+    if stored and stored[0] == user_token:
+        return stored[1]
+    return None
 
 
 @user_logged_in.connect_via(app)
@@ -92,12 +161,18 @@ def when_user_logged_in(sender, user, **extra):
     remember me and other flask-loging features.
     """
     wallet_cache_put(user.user_token, user.wallet.address)
+    remember_wallet(user.user_token, user.wallet.address)
+    if sender.wallet_prefetcher:
+        sender.wallet_prefetcher.submit(user.wallet.address)
 
 
 @login_manager.user_loader
 def load_user(user_id):
     logging.debug(f"load_user: {user_id}")
-    wallet = wallet_cache_get(user_id)
+    wallet = session_wallet(user_id) or user_wallets.get(user_id)
+    if wallet is None:
+        wallet = wallet_cache_get(user_id)
+        remember_wallet(user_id, wallet)
     logging.debug(f"{user_id, wallet}")
     return XUMMUser(user_id, account=wallet)
 
@@ -112,11 +187,19 @@ def index():
 @login_required
 def logout():
     logout_user()
+    session.pop(SESSION_WALLET, None)
     return redirect(url_for("index"))
 
 
-from flask_nft_xumm.wallet import mint_request, mint_signed
-from flask_nft_xumm.trade import sqlite_stock_update, sale_created
+from flask_nft_xumm.wallet import mint_request, mint_signed, offer_cancelled
+from flask_nft_xumm.trade import (
+    on_payload_resolved,
+    sale_completed,
+    sale_created,
+    sqlite_stock_update,
+)
+from flask_nft_xumm.utils import invalidate_signal_accounts
+from flask_nft_xumm.webhook import payload_resolved
 
 # Wire up some simple signal handlers
 
@@ -125,6 +208,13 @@ from flask_nft_xumm.trade import sqlite_stock_update, sale_created
 # once signed) to a database or similar
 
 sale_created.connect(sqlite_stock_update, app)
+payload_resolved.connect(on_payload_resolved, app)
+
+# Drop the cached wallets of everyone a transaction touched, so they see its
+# effect straight away (and again once it's validated). A new listing's
+# seller is dropped by sqlite_stock_update, once its offer is on the ledger.
+for signal in (mint_signed, offer_cancelled, sale_completed):
+    signal.connect(invalidate_signal_accounts, app)
 
 
 @mint_request.connect_via(app)
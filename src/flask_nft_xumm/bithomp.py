@@ -0,0 +1,153 @@
+"""
+A client for Bithomp's NFT API.
+
+`BithompClient` keeps a pooled `requests.Session` per process, so lookups
+reuse warm TLS connections rather than opening one each, and only asks for
+the fields the caller wants. Responses are kept in the shared cache (by
+default the sqlite file every worker shares, see `shared_cache`) for
+`stale_after` seconds. After that they're revalidated with `If-None-Match` /
+`If-Modified-Since` when Bithomp gave an ETag or Last-Modified, so an
+unchanged NFT costs a 304 rather than the full payload, and kept for up to
+`keep_for` seconds.
+
+`prefetch` looks up a list of NFTs side by side, e.g. to warm a page of
+listings before it's rendered.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from xrpl.utils import hex_to_str
+
+from flask_nft_xumm.cache import SingleFlight
+from flask_nft_xumm.shared_cache import SharedCache
+
+FIELDS = ("sellOffers", "buyOffers", "uri", "history")
+POOL_SIZE = 10
+TIMEOUT = 10
+STALE_AFTER = 300
+KEEP_FOR = 7 * 24 * 60 * 60
+
+BithompLookup = namedtuple("BithompLookup", "nft_id data error")
+
+bithomp_cache = SharedCache("bithomp", ttl=KEEP_FOR, maxsize=128)
+
+
+class BithompClient:
+    def __init__(
+        self,
+        base_url,
+        token,
+        pool_size=POOL_SIZE,
+        timeout=TIMEOUT,
+        stale_after=STALE_AFTER,
+        keep_for=KEEP_FOR,
+        cache=bithomp_cache,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.keep_for = keep_for
+        self.cache = cache
+        self.flight = SingleFlight()
+        self.requests = self.not_modified = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """This process's session; one made before a fork isn't reused, as
+        its pooled sockets are shared with the parent."""
+        with self._lock:
+            if self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size, pool_block=True
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers["x-bithomp-token"] = self.token
+                self._session, self._pid = session, os.getpid()
+            return self._session
+
+    def _fetch(self, key, path, params):
+        entry = self.cache.get(key)
+        if entry is not None and time.time() - entry["fetched_at"] < self.stale_after:
+            return entry["data"]
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = self.session.get(
+            f"{self.base_url}{path}",
+            params=params,
+            headers=headers,
+            timeout=self.timeout,
+        )
+        self.requests += 1
+        if response.status_code == 304 and entry is not None:
+            self.not_modified += 1
+            entry = dict(entry, fetched_at=time.time())
+        else:
+            response.raise_for_status()
+            entry = {"data": response.json(), "fetched_at": time.time()}
+        # A 304 may leave out the validators it was sent
+        for name, header in (("etag", "ETag"), ("last_modified", "Last-Modified")):
+            if header in response.headers:
+                entry[name] = response.headers[header]
+        self.cache.set(key, entry, self.keep_for)
+        return entry["data"]
+
+    def get(self, path, params=None):
+        """GET `path` from the API as JSON, through the cache. Concurrent
+        calls for the same thing share one request."""
+        params = params or {}
+        key = (path, *(f"{k}={v}" for k, v in sorted(params.items())))
+        return self.flight.do(key, self._fetch, key, path, params)
+
+    def nft(self, nft_id, fields=FIELDS):
+        """Bithomp's details of `nft_id`, including only the optional
+        `fields` asked for (any of `FIELDS`)."""
+        data = dict(self.get(f"/api/v2/nft/{nft_id}", {f: "true" for f in fields}))
+        if data.get("uri"):
+            data["uri_hex"] = data["uri"]
+            data["uri"] = hex_to_str(data["uri"])
+        return data
+
+    def _lookup(self, nft_id, fields):
+        try:
+            return BithompLookup(nft_id, self.nft(nft_id, fields), None)
+        except Exception as e:
+            return BithompLookup(nft_id, None, str(e) or e.__class__.__name__)
+
+    def prefetch(self, nft_ids, fields=FIELDS, max_in_flight=None):
+        """Look up every NFT in `nft_ids` at once, at most `max_in_flight`
+        (default the pool size) at a time.
+
+        Returns a list of `BithompLookup(nft_id, data, error)` in the same
+        order as `nft_ids`; a failed lookup has `data` None and a message in
+        `error` rather than raising.
+        """
+        nft_ids = list(nft_ids)
+        unique = list(dict.fromkeys(nft_ids))
+        if not unique:
+            return []
+        workers = max(1, min(max_in_flight or self.pool_size, len(unique)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            lookups = dict(
+                zip(unique, pool.map(lambda n: self._lookup(n, fields), unique))
+            )
+        return [lookups[n] for n in nft_ids]
+
+    def stats(self):
+        return dict(
+            self.cache.stats(), requests=self.requests, not_modified=self.not_modified
+        )
@@ -0,0 +1,199 @@
+"""
+Process wide caches for ledger data.
+
+Unlike `decorators.time_cache` these are keyed on plain values (account
+addresses, token ids) rather than on the objects asking, so every
+`XUMMWalletProxy` built for a request shares the same entries.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+def deep_sizeof(obj, seen=None):
+    """Rough estimate of the memory held by `obj` and everything it contains."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(x, seen) for x in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    elif hasattr(obj, "__slots__"):
+        size += sum(
+            deep_sizeof(getattr(obj, name), seen)
+            for name in obj.__slots__
+            if hasattr(obj, name)
+        )
+    return size
+
+
+class TTLCache:
+    """A thread safe, size bounded LRU cache whose entries expire after `ttl`
+    seconds.
+
+    Keeps `hits`, `misses`, `evictions` and `expirations` counters, see
+    `stats()`.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not _missing
+
+    def _lookup(self, key):
+        entry = self._data.get(key, _missing)
+        if entry is _missing:
+            return _missing
+        expires, value = entry
+        if expires <= self._timer():
+            del self._data[key]
+            self.expirations += 1
+            return _missing
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            expires = self._timer() + (self.ttl if ttl is None else ttl)
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, factory, force=False):
+        """Return the cached value for `key`, calling `factory()` to fill it
+        on a miss (or always, if `force` is set)."""
+        if not force:
+            value = self.get(key, _missing)
+            if value is not _missing:
+                return value
+        value = factory()
+        self.set(key, value)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Drop every entry whose key matches `predicate(key)`."""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def memory_usage(self):
+        """Approximate number of bytes held by the cached keys and values."""
+        with self._lock:
+            return deep_sizeof(self._data) - sys.getsizeof(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one.
+
+    The first caller for a key (the leader) does the work; anyone asking for
+    the same key while it's in flight waits and gets the leader's result, or
+    its exception. Nothing is kept once the call finishes, pair with a
+    `TTLCache` for that.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = self.shared = 0
+
+    def begin(self, key):
+        """Returns `(leader, call)`. The leader must pass the outcome to
+        `finish`, everyone else calls `call.wait()`."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                return False, call
+            call = self._calls[key] = _Call()
+            self.calls += 1
+            return True, call
+
+    def finish(self, key, call, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        call.result, call.error = result, error
+        call.done.set()
+
+    def do(self, key, fn, *args, **kwargs):
+        leader, call = self.begin(key)
+        if not leader:
+            return call.wait()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result=result)
+        return result
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "in_flight": len(self._calls),
+        }
@@ -0,0 +1,674 @@
+"""
+Access to the sqlite database that holds the app's state.
+
+Each thread (and each forked worker) gets its own long lived connection, in
+WAL mode so readers don't block the writer. Statements are reused through
+sqlite3's per-connection statement cache, so keep the SQL in here as fixed
+strings with bound parameters.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from os import environ
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+)
+
+StockRow = namedtuple(
+    "StockRow",
+    "id token_id sale_offer signed seller issuer transfer_fee price checked_at "
+    "serial uri",
+)
+_STOCK_COLUMNS = (
+    "id, token_id, sale_offer, signed, seller, issuer, transfer_fee, price, "
+    "checked_at, serial, uri"
+)
+
+SettlementRow = namedtuple(
+    "SettlementRow",
+    "id payload_uuid nft_id buyer seller sell_offer amount state attempts "
+    "next_attempt_at tx_hash tx_blob result error created_at updated_at",
+)
+SETTLEMENT_FINISHED = {"settled", "failed"}
+_SETTLEMENT_COLUMNS = (
+    "id, payload_uuid, nft_id, buyer, seller, sell_offer, amount, state, "
+    "attempts, next_attempt_at, tx_hash, tx_blob, result, error, created_at, "
+    "updated_at"
+)
+
+PayloadRow = namedtuple(
+    "PayloadRow",
+    "uuid kind account context resolved signed txid user_token created_at "
+    "resolved_at",
+)
+_PAYLOAD_COLUMNS = (
+    "uuid, kind, account, context, resolved, signed, txid, user_token, "
+    "created_at, resolved_at"
+)
+
+_local = threading.local()
+
+
+def db_path():
+    return environ.get("XUMM_DB_PATH", "xumm.db")
+
+
+def connect(path=None):
+    con = sqlite3.connect(path or db_path(), cached_statements=256)
+    for pragma in PRAGMAS:
+        con.execute(pragma)
+    return con
+
+
+def connection():
+    """The calling thread's connection, opened on first use.
+
+    Connections aren't shared over a fork, so a worker that inherits one from
+    its parent opens a fresh one instead.
+    """
+    con = getattr(_local, "con", None)
+    if con is None or _local.pid != os.getpid():
+        con = _local.con = connect()
+        _local.pid = os.getpid()
+    return con
+
+
+def close():
+    con = getattr(_local, "con", None)
+    if con is not None and _local.pid == os.getpid():
+        con.close()
+    _local.con = None
+
+
+def stock_insert(
+    token_id,
+    sale_offer,
+    signed,
+    seller,
+    issuer=None,
+    transfer_fee=None,
+    price=None,
+    checked_at=None,
+    serial=None,
+    uri=None,
+):
+    """Add a listing, unless one for `sale_offer` already exists."""
+    with connection() as con:
+        con.execute(
+            "insert into stock (token_id, sale_offer, signed, seller, issuer, "
+            "transfer_fee, price, created_at, checked_at, serial, uri) "
+            "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "on conflict (sale_offer) do nothing",
+            (
+                token_id,
+                sale_offer,
+                signed,
+                seller,
+                issuer,
+                transfer_fee,
+                price,
+                int(time.time()),
+                checked_at,
+                serial,
+                uri,
+            ),
+        )
+
+
+def stock_mark_signed(pending_offer, sale_offer):
+    """Swap the XUMM payload id a listing was stored under for the ledger's
+    offer id, now the seller has signed it.
+
+    The offer may have been imported from the ledger in the meantime (see
+    `reconcile.import_ledger_offers`), in which case the imported row gives
+    way to this one, which knows the token's URI, keeping when it was last
+    checked."""
+
+    def mark(con):
+        pending = con.execute(
+            "select id from stock where sale_offer = ?", (pending_offer,)
+        ).fetchone()
+        if pending is None:
+            return
+        imported = con.execute(
+            "select checked_at from stock where sale_offer = ?", (sale_offer,)
+        ).fetchone()
+        if imported is not None:
+            con.execute("delete from stock where sale_offer = ?", (sale_offer,))
+        con.execute(
+            "update stock set signed = 1, sale_offer = ?, "
+            "checked_at = coalesce(checked_at, ?) where id = ?",
+            (sale_offer, imported[0] if imported else None, pending[0]),
+        )
+
+    _immediate(connection(), mark)
+
+
+def stock_delete_offer(sale_offer):
+    with connection() as con:
+        con.execute("delete from stock where sale_offer = ?", (sale_offer,))
+
+
+def stock_set_uri(token_id, uri):
+    """Fill in the decoded URI for every listing of `token_id`."""
+    with connection() as con:
+        con.execute(
+            "update stock set uri = ? where token_id = ? and uri is null",
+            (uri, token_id),
+        )
+
+
+def stock_delete_ids(ids):
+    with connection() as con:
+        con.executemany("delete from stock where id = ?", [(id,) for id in ids])
+
+
+def stock_mark_checked(checked, checked_at):
+    """Record that the listings in `checked`, a list of `(id, price)`, were
+    found on the ledger at `checked_at`. A None price leaves the old one."""
+    with connection() as con:
+        con.executemany(
+            "update stock set checked_at = ?, price = coalesce(?, price) where id = ?",
+            [(checked_at, price, id) for id, price in checked],
+        )
+
+
+def stock_prune_unsigned(before):
+    """Remove listings that were never signed and were created before
+    `before`, returning how many went."""
+    with connection() as con:
+        return con.execute(
+            "delete from stock where signed = 0 and created_at < ?", (before,)
+        ).rowcount
+
+
+def stock_signed(seller=None):
+    """Every signed listing, optionally only those from `seller`."""
+    sql = f"select {_STOCK_COLUMNS} from stock where signed = 1"
+    params = ()
+    if seller:
+        sql += " and seller = ?"
+        params = (seller,)
+    return [StockRow(*row) for row in connection().execute(sql, params)]
+
+
+def stock_page(
+    after=0,
+    limit=20,
+    seller=None,
+    issuer=None,
+    min_price=None,
+    max_price=None,
+    max_fee=None,
+):
+    """One page of signed listings, in id order, starting after the listing
+    with id `after`.
+
+    Prices are in drops and `max_fee` in transfer fee units (1/1000 of a
+    percent); listings with no recorded price never match a price filter.
+    Returns `(rows, next_after)`, where `next_after` is None on the last page.
+    """
+    sql = f"select {_STOCK_COLUMNS} from stock where signed = 1 and id > ?"
+    params = [after]
+    for clause, value in [
+        ("seller = ?", seller),
+        ("issuer = ?", issuer),
+        ("price >= ?", min_price),
+        ("price <= ?", max_price),
+        ("transfer_fee <= ?", max_fee),
+    ]:
+        if value is not None:
+            sql += f" and {clause}"
+            params.append(value)
+    sql += " order by id limit ?"
+    params.append(limit + 1)
+    rows = [StockRow(*row) for row in connection().execute(sql, params)]
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+def stock_accounts():
+    """Every seller and issuer with something in stock."""
+    sql = (
+        "select seller from stock union "
+        "select issuer from stock where issuer is not null"
+    )
+    return {row[0] for row in connection().execute(sql)}
+
+
+def _offer_row(offer, ledger_index):
+    amount = offer["amount"]
+    if not isinstance(amount, str):
+        amount = json.dumps(amount)
+    return (
+        offer["nft_offer_index"],
+        offer["nft_id"],
+        offer["owner"],
+        amount,
+        offer.get("destination"),
+        offer.get("flags", 1),
+        ledger_index,
+    )
+
+
+def _offer_dict(row):
+    """A sell_offer row in the shape NFTSellOffers returns offers in."""
+    offer_id, token_id, owner, amount, destination, flags = row
+    offer = {
+        "nft_offer_index": offer_id,
+        "owner": owner,
+        "amount": json.loads(amount) if amount.startswith("{") else amount,
+        "flags": flags,
+    }
+    if destination:
+        offer["destination"] = destination
+    return offer
+
+
+def mirror_update(
+    created_offers=(), deleted_offers=(), owners=None, disowned=(), ledger_index=None
+):
+    """Apply the changes from one transaction to the mirror tables, atomically.
+
+    `created_offers` are dicts as returned by NFTSellOffers plus an `nft_id`,
+    `owners` maps token id to `(owner, uri)`.
+    """
+    with connection() as con:
+        con.executemany(
+            "delete from sell_offer where offer_id = ?",
+            [(offer_id,) for offer_id in deleted_offers],
+        )
+        con.executemany(
+            "insert or replace into sell_offer (offer_id, token_id, owner, amount, "
+            "destination, flags, ledger_index) values (?, ?, ?, ?, ?, ?, ?)",
+            [_offer_row(offer, ledger_index) for offer in created_offers],
+        )
+        con.executemany(
+            "delete from nft_owner where token_id = ?",
+            [(token_id,) for token_id in disowned],
+        )
+        con.executemany(
+            "insert or replace into nft_owner (token_id, owner, uri, ledger_index) "
+            "values (?, ?, ?, ?)",
+            [
+                (token_id, owner, uri, ledger_index)
+                for token_id, (owner, uri) in (owners or {}).items()
+            ],
+        )
+
+
+def mirror_replace_offers(token_id, offers, ledger_index=None):
+    """Replace everything known about `token_id`'s sell offers with `offers`."""
+    with connection() as con:
+        con.execute("delete from sell_offer where token_id = ?", (token_id,))
+        con.executemany(
+            "insert or replace into sell_offer (offer_id, token_id, owner, amount, "
+            "destination, flags, ledger_index) values (?, ?, ?, ?, ?, ?, ?)",
+            [_offer_row(dict(o, nft_id=token_id), ledger_index) for o in offers],
+        )
+
+
+def mirror_replace_owned(owner, nfts, ledger_index=None):
+    """Replace the NFTs `owner` is known to hold with `nfts`, a list of
+    `(token_id, uri)`."""
+    with connection() as con:
+        con.execute("delete from nft_owner where owner = ?", (owner,))
+        con.executemany(
+            "insert or replace into nft_owner (token_id, owner, uri, ledger_index) "
+            "values (?, ?, ?, ?)",
+            [(token_id, owner, uri, ledger_index) for token_id, uri in nfts],
+        )
+
+
+def mirror_owner(token_id):
+    sql = "select owner from nft_owner where token_id = ?"
+    row = connection().execute(sql, (token_id,)).fetchone()
+    return row[0] if row else None
+
+
+def mirror_sell_offers(token_ids):
+    """Open sell offers for each of `token_ids`, as a dict of token id to a list
+    of offers."""
+    sql = (
+        "select offer_id, token_id, owner, amount, destination, flags "
+        "from sell_offer where token_id in (select value from json_each(?)) "
+        "order by ledger_index, offer_id"
+    )
+    offers = {token_id: [] for token_id in token_ids}
+    for row in connection().execute(sql, (json.dumps(list(offers)),)):
+        offers[row[1]].append(_offer_dict(row))
+    return offers
+
+
+def mirror_offers_by_owner(owner):
+    """`(token_id, offer_id)` for every open sell offer made by `owner`."""
+    sql = "select token_id, offer_id from sell_offer where owner = ?"
+    return connection().execute(sql, (owner,)).fetchall()
+
+
+def _immediate(con, fn):
+    # Read-then-write, with the write lock held throughout so no other
+    # process can read the same value in between
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn(con)
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    return result
+
+
+def _settlement_row(row):
+    if row is None:
+        return None
+    row = SettlementRow(*row)
+    return row._replace(result=json.loads(row.result) if row.result else None)
+
+
+def settlement_enqueue(payload_uuid, nft_id, buyer, seller, sell_offer, amount):
+    """Queue the brokered sale of `nft_id` for settlement, returning its job.
+
+    `payload_uuid`, the XUMM payload the buyer signed their offer with, is
+    the idempotency key: queueing it again returns the existing job.
+    """
+    now = int(time.time())
+    with connection() as con:
+        con.execute(
+            "insert into settlement (payload_uuid, nft_id, buyer, seller, "
+            "sell_offer, amount, next_attempt_at, created_at, updated_at) "
+            "values (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "on conflict (payload_uuid) do nothing",
+            (payload_uuid, nft_id, buyer, seller, sell_offer, amount, now, now, now),
+        )
+    return settlement_get(payload_uuid)
+
+
+def settlement_get(payload_uuid):
+    sql = f"select {_SETTLEMENT_COLUMNS} from settlement where payload_uuid = ?"
+    return _settlement_row(connection().execute(sql, (payload_uuid,)).fetchone())
+
+
+def settlement_claim(lease, now=None):
+    """Take the next job that's due, marking it running, or None.
+
+    A running job that hasn't been touched for `lease` seconds is assumed to
+    belong to a worker that died, and is claimed again.
+    """
+    now = int(now or time.time())
+
+    def take(con):
+        row = con.execute(
+            f"select {_SETTLEMENT_COLUMNS} from settlement "
+            "where (state = 'queued' and next_attempt_at <= ?) "
+            "or (state = 'running' and updated_at < ?) "
+            "order by next_attempt_at limit 1",
+            (now, now - lease),
+        ).fetchone()
+        if row is not None:
+            con.execute(
+                "update settlement set state = 'running', "
+                "attempts = attempts + 1, updated_at = ? where id = ?",
+                (now, row[0]),
+            )
+        return row
+
+    row = _immediate(connection(), take)
+    if row is None:
+        return None
+    job = _settlement_row(row)
+    return job._replace(state="running", attempts=job.attempts + 1, updated_at=now)
+
+
+def settlement_signed(id, tx_hash, tx_blob):
+    """Record the signed transaction for job `id`, before it's submitted."""
+    with connection() as con:
+        con.execute(
+            "update settlement set tx_hash = ?, tx_blob = ?, updated_at = ? "
+            "where id = ?",
+            (tx_hash, tx_blob, int(time.time()), id),
+        )
+
+
+def settlement_finish(id, state, result=None, error=None, next_attempt_at=None):
+    """Move job `id` to `state`: 'settled' or 'failed' with the ledger's
+    `result`, or back to 'queued' to be retried at `next_attempt_at`."""
+    now = int(time.time())
+    with connection() as con:
+        con.execute(
+            "update settlement set state = ?, result = ?, error = ?, "
+            "next_attempt_at = coalesce(?, next_attempt_at), updated_at = ? "
+            "where id = ?",
+            (
+                state,
+                None if result is None else json.dumps(result),
+                error,
+                next_attempt_at,
+                now,
+                id,
+            ),
+        )
+
+
+def sequence_next(account):
+    """Hand out the next sequence number for `account`, or None if it's not
+    known yet (see `sequence_reset`). It's in flight until `sequence_done` or
+    `sequence_release` is called for it."""
+
+    def take(con):
+        row = con.execute(
+            "select next_sequence from account_sequence where account = ?",
+            (account,),
+        ).fetchone()
+        if row is not None:
+            con.execute(
+                "update account_sequence set next_sequence = next_sequence + 1 "
+                "where account = ?",
+                (account,),
+            )
+            con.execute(
+                "insert or replace into sequence_in_flight "
+                "(account, sequence, claimed_at) values (?, ?, ?)",
+                (account, row[0], int(time.time())),
+            )
+        return row[0] if row else None
+
+    return _immediate(connection(), take)
+
+
+def sequence_reset(account, next_sequence):
+    with connection() as con:
+        con.execute(
+            "insert into account_sequence (account, next_sequence) values (?, ?) "
+            "on conflict (account) do update set next_sequence = excluded.next_sequence",
+            (account, next_sequence),
+        )
+
+
+def sequence_done(account, sequence):
+    """A transaction using `sequence` was validated."""
+    with connection() as con:
+        con.execute(
+            "delete from sequence_in_flight where account = ? and sequence = ?",
+            (account, sequence),
+        )
+
+
+def sequence_release(account, sequence, stale_before):
+    """A transaction using `sequence` will never be validated. Returns how
+    many sequence numbers handed out since `stale_before` are still in
+    flight (older ones are forgotten)."""
+
+    def release(con):
+        con.execute(
+            "delete from sequence_in_flight "
+            "where account = ? and (sequence = ? or claimed_at < ?)",
+            (account, sequence, int(stale_before)),
+        )
+        return con.execute(
+            "select count(*) from sequence_in_flight where account = ?", (account,)
+        ).fetchone()[0]
+
+    return _immediate(connection(), release)
+
+
+def sequence_resync(account, next_sequence, stale_before):
+    """`sequence_reset`, but only if no sequence number handed out since
+    `stale_before` is in flight. Returns whether it reset."""
+
+    def reset(con):
+        in_flight = con.execute(
+            "select count(*) from sequence_in_flight "
+            "where account = ? and claimed_at >= ?",
+            (account, int(stale_before)),
+        ).fetchone()[0]
+        if in_flight:
+            return False
+        con.execute(
+            "insert into account_sequence (account, next_sequence) values (?, ?) "
+            "on conflict (account) do update set next_sequence = excluded.next_sequence",
+            (account, next_sequence),
+        )
+        return True
+
+    return _immediate(connection(), reset)
+
+
+def ticket_claim(account):
+    """Hand out the lowest unclaimed ticket `account` holds, or None."""
+
+    def take(con):
+        row = con.execute(
+            "select min(ticket_sequence) from ticket "
+            "where account = ? and claimed_at is null",
+            (account,),
+        ).fetchone()
+        if row[0] is not None:
+            con.execute(
+                "update ticket set claimed_at = ? "
+                "where account = ? and ticket_sequence = ?",
+                (int(time.time()), account, row[0]),
+            )
+        return row[0]
+
+    return _immediate(connection(), take)
+
+
+def ticket_release(account, ticket_sequence):
+    """Put a claimed ticket back, its transaction never made it."""
+    with connection() as con:
+        con.execute(
+            "update ticket set claimed_at = null "
+            "where account = ? and ticket_sequence = ?",
+            (account, ticket_sequence),
+        )
+
+
+def ticket_replace(account, ticket_sequences, stale_before):
+    """Make the tickets for `account` exactly `ticket_sequences` (what the
+    ledger says it holds), keeping claims on them made since `stale_before`."""
+    ticket_sequences = list(ticket_sequences)
+    with connection() as con:
+        con.execute(
+            "update ticket set claimed_at = null where account = ? and claimed_at < ?",
+            (account, int(stale_before)),
+        )
+        con.execute(
+            "delete from ticket where account = ? and ticket_sequence not in "
+            "(select value from json_each(?))",
+            (account, json.dumps(ticket_sequences)),
+        )
+        con.executemany(
+            "insert or ignore into ticket (account, ticket_sequence) values (?, ?)",
+            [(account, t) for t in ticket_sequences],
+        )
+
+
+def ticket_used(account, ticket_sequence):
+    with connection() as con:
+        con.execute(
+            "delete from ticket where account = ? and ticket_sequence = ?",
+            (account, ticket_sequence),
+        )
+
+
+def ticket_available(account):
+    sql = "select count(*) from ticket where account = ? and claimed_at is null"
+    return connection().execute(sql, (account,)).fetchone()[0]
+
+
+def payload_track(uuid, kind, account=None, context=None):
+    """Record a XUMM payload the app has created, `kind` saying what it's
+    for and `context` (a dict) anything needed to act on it once signed."""
+    with connection() as con:
+        con.execute(
+            "insert into xumm_payload (uuid, kind, account, context, created_at) "
+            "values (?, ?, ?, ?, ?) on conflict (uuid) do nothing",
+            (uuid, kind, account, json.dumps(context or {}), int(time.time())),
+        )
+
+
+def payload_get(uuid):
+    sql = f"select {_PAYLOAD_COLUMNS} from xumm_payload where uuid = ?"
+    row = connection().execute(sql, (uuid,)).fetchone()
+    if row is None:
+        return None
+    row = PayloadRow(*row)
+    return row._replace(context=json.loads(row.context or "{}"))
+
+
+def payload_resolve(uuid, signed, txid=None, account=None, user_token=None):
+    """Store the outcome of payload `uuid`, returning True only for the call
+    that resolved it, so whatever follows happens once."""
+    with connection() as con:
+        return (
+            con.execute(
+                "update xumm_payload set resolved = 1, signed = ?, txid = ?, "
+                "account = coalesce(?, account), user_token = ?, resolved_at = ? "
+                "where uuid = ? and resolved = 0",
+                (int(signed), txid, account, user_token, int(time.time()), uuid),
+            ).rowcount
+            == 1
+        )
+
+
+def payload_unresolve(uuid):
+    """Undo `payload_resolve`, when acting on the outcome failed and should
+    be tried again."""
+    with connection() as con:
+        con.execute("update xumm_payload set resolved = 0 where uuid = ?", (uuid,))
+
+
+def transaction_tracked(tx_hash):
+    """Whether `tx_hash` is the transaction of a payload the app had signed,
+    or of a settlement."""
+    sql = (
+        "select 1 from xumm_payload where txid = ? "
+        "union all select 1 from settlement where tx_hash = ? limit 1"
+    )
+    return connection().execute(sql, (tx_hash, tx_hash)).fetchone() is not None
+
+
+def wallet_cache_put(user_token, wallet_address):
+    with connection() as con:
+        con.execute(
+            "insert into wallet_cache (user_token, wallet_address) values (?, ?) "
+            "on conflict(user_token) do update set wallet_address = excluded.wallet_address",
+            (user_token, wallet_address),
+        )
+
+
+def wallet_cache_get(user_token):
+    """The wallet address stored for `user_token`, or None."""
+    sql = "select wallet_address from wallet_cache where user_token = ?"
+    row = connection().execute(sql, (user_token,)).fetchone()
+    return row[0] if row else None
@@ -1,12 +1,10 @@
-import sqlite3
+"""
+Create or upgrade the database, see `flask_nft_xumm.migrations`.
+"""
+from flask_nft_xumm import db
+from flask_nft_xumm.migrations import migrate
 
-con = sqlite3.connect("xumm.db")
-cur = con.cursor()
-cur.execute(
-    "CREATE TABLE stock (token_id text, sale_offer text, signed integer, seller text)"
-)
-cur.execute(
-    "create table wallet_cache (user_token varchar primary key, wallet_address varchar)"
-)
-con.commit()
-con.close()
+if __name__ == "__main__":
+    con = db.connect()
+    print(f"{db.db_path()} is at schema version {migrate(con)}")
+    con.close()
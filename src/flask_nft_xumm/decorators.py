@@ -5,6 +5,8 @@ from flask import current_app, request
 from flask_login import current_user
 from xrpl.utils import str_to_hex
 
+from flask_nft_xumm.cache import SingleFlight, TTLCache
+
 
 class NFTAccessDenied(Exception):
     status_code = 403
@@ -22,16 +24,48 @@ class NFTAccessDenied(Exception):
         return rv
 
 
+# Recent answers to "does this account hold that NFT?", keyed on (account,
+# "id" or "uri", value, version of the wallet's cached NFTs). A change to the
+# wallet made through any worker gives it a new version (once this worker's
+# local copy of the wallet lapses, see `shared_cache`), so the old answers
+# stop being used; `utils.invalidate_account` drops them straight away in
+# this one. Denials are kept for less time than grants.
+ALLOW_TTL = 60
+DENY_TTL = 15
+access_decisions = TTLCache(maxsize=4096)
+
+
+def holds_nft(wallet, **query):
+    """`wallet.has_nft(**query)`, for a single `id` or `uri`, through
+    `access_decisions`."""
+    ((kind, value),) = query.items()
+    version = wallet.nfts_version()
+    allowed = None
+    if version is not None:
+        allowed = access_decisions.get((wallet.address, kind, value, version))
+    if allowed is None:
+        allowed = wallet.has_nft(**query)
+        # has_nft may have just (re)loaded the wallet
+        version = wallet.nfts_version()
+        if version is not None:
+            access_decisions.set(
+                (wallet.address, kind, value, version),
+                allowed,
+                ALLOW_TTL if allowed else DENY_TTL,
+            )
+    return allowed
+
+
 def nft_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if "nft_id" in request.view_args:
-            if not current_user.wallet.has_nft(id=request.view_args["nft_id"]):
+            if not holds_nft(current_user.wallet, id=request.view_args["nft_id"]):
                 msg = f"You do not own the NFT with ID: {request.view_args['nft_id']}"
                 raise NFTAccessDenied(msg)
         else:
-            if not current_user.wallet.has_nft(uri=request.url):
-                msg = f"You do not own the NFT at this URL: {uri}"
+            if not holds_nft(current_user.wallet, uri=request.url):
+                msg = f"You do not own the NFT at this URL: {request.url}"
                 raise NFTAccessDenied(msg)
 
         return f(*args, **kwargs)
@@ -62,3 +96,18 @@ def time_cache(max_age, maxsize=128, typed=False):
         return _wrapped
 
     return _decorator
+
+
+def coalesce(fn):
+    """
+    Concurrent calls with the same arguments share one call to `fn`, and its
+    result or exception. See `cache.SingleFlight`.
+    """
+    flight = SingleFlight()
+
+    @wraps(fn)
+    def _wrapped(*args, **kwargs):
+        return flight.do((args, tuple(sorted(kwargs.items()))), fn, *args, **kwargs)
+
+    _wrapped.flight = flight
+    return _wrapped
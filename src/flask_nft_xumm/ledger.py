@@ -0,0 +1,132 @@
+"""
+Helpers for talking to the ledger in bulk, rather than one blocking request
+per row.
+"""
+import asyncio
+import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from xrpl.models.requests import AccountNFTs, NFTSellOffers
+from xrpl.models.requests.request import RequestMethod
+
+from flask_nft_xumm.cache import SingleFlight
+
+MAX_IN_FLIGHT = 8
+
+OfferLookup = namedtuple("OfferLookup", "nft_id offers error")
+
+# Read only requests, which are safe for concurrent callers to share
+COALESCED_METHODS = {
+    RequestMethod.ACCOUNT_INFO,
+    RequestMethod.ACCOUNT_NFTS,
+    RequestMethod.ACCOUNT_OBJECTS,
+    RequestMethod.NFT_SELL_OFFERS,
+    RequestMethod.NFT_BUY_OFFERS,
+    RequestMethod.TX,
+    RequestMethod.LEDGER,
+    RequestMethod.FEE,
+    RequestMethod.SERVER_INFO,
+}
+
+
+def nft_serial_and_taxon(nft_id):
+    """The serial and taxon encoded in an NFTokenID. The ledger stores the
+    taxon scrambled with the serial (see XLS-20), so undo that here."""
+    serial = int(nft_id[56:64], 16)
+    scrambled = int(nft_id[48:56], 16)
+    return serial, scrambled ^ ((384160001 * serial + 2459) % 2**32)
+
+
+def holds_nft(account, nft_id, client):
+    """Whether `account` holds `nft_id`, paging through its AccountNFTs only
+    until the token turns up. An account the ledger won't list (e.g. one
+    that doesn't exist) holds nothing."""
+    marker = None
+    while True:
+        result = client.request(
+            AccountNFTs(account=account, limit=400, marker=marker)
+        ).result
+        if any(n["NFTokenID"] == nft_id for n in result.get("account_nfts", [])):
+            return True
+        marker = result.get("marker")
+        if not marker:
+            return False
+
+
+def _sell_offers(nft_id, client):
+    try:
+        response = client.request(NFTSellOffers(nft_id=nft_id))
+    except Exception as e:
+        return OfferLookup(nft_id, [], str(e) or e.__class__.__name__)
+    result = response.result
+    if response.is_successful():
+        return OfferLookup(nft_id, result.get("offers", []), None)
+    # The ledger reports a token with no sell offers as objectNotFound, which
+    # for our purposes is just an empty list.
+    if result.get("error") == "objectNotFound":
+        return OfferLookup(nft_id, [], None)
+    return OfferLookup(nft_id, [], result.get("error_message", result.get("error")))
+
+
+def resolve_sell_offers(nft_ids, client, max_in_flight=MAX_IN_FLIGHT):
+    """Look up the sell offers for every token in `nft_ids` at the same time.
+
+    At most `max_in_flight` requests are outstanding against `client` at once.
+    Returns a list of `OfferLookup(nft_id, offers, error)`, in the same order as
+    `nft_ids`; a failed lookup has an empty `offers` list and a message in
+    `error` rather than raising, so one bad token doesn't sink the page.
+    """
+    nft_ids = list(nft_ids)
+    unique = list(dict.fromkeys(nft_ids))
+    if not unique:
+        return []
+    workers = max(1, min(max_in_flight, len(unique)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        lookups = dict(zip(unique, pool.map(lambda n: _sell_offers(n, client), unique)))
+    return [lookups[n] for n in nft_ids]
+
+
+class CoalescingClient:
+    """Wraps an xrpl client so that concurrent, identical read requests share
+    a single round trip (and its result, or error). Everything else is passed
+    straight through to the wrapped client.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.flight = SingleFlight()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _key(self, request):
+        if request.method not in COALESCED_METHODS:
+            return None
+        data = request.to_dict()
+        data.pop("id", None)
+        return json.dumps(data, sort_keys=True, default=str)
+
+    def request(self, request):
+        key = self._key(request)
+        if key is None:
+            return self.client.request(request)
+        return self.flight.do(key, self.client.request, request)
+
+    async def request_impl(self, request):
+        # What the xrpl helper functions (get_account_info etc.) call
+        key = self._key(request)
+        if key is None:
+            return await self.client.request_impl(request)
+        leader, call = self.flight.begin(key)
+        if not leader:
+            # The leader may be on this event loop, so wait without blocking
+            # it
+            return await asyncio.get_running_loop().run_in_executor(None, call.wait)
+        try:
+            response = await self.client.request_impl(request)
+        except BaseException as e:
+            self.flight.finish(key, call, error=e)
+            raise
+        self.flight.finish(key, call, result=response)
+        return response
@@ -0,0 +1,115 @@
+"""
+The record `app.nft_factory` returns by default, one per NFT on a page.
+
+Shop and wallet pages build one for every NFT they list, so `NFTListing`
+keeps to `__slots__` rather than carrying a dict each, holds the offer it's
+given rather than a copy. The shop and wallet pages pass every field, from
+the stock table and AccountNFTs; anything a caller leaves out (the issuer,
+transfer fee and serial come from the token id, the URI from `uri_hex`) is
+only worked out when something reads it.
+
+It reads like the dict `nft_factory` used to return: `n["uri"]`,
+`n.get("offer")`, `"fee" in n`, `dict(n)`, and a missing key raises
+`KeyError`, so templates that index it carry on working.
+"""
+from functools import lru_cache
+
+from xrpl.core.addresscodec import encode_classic_address
+
+from flask_nft_xumm.ledger import nft_serial_and_taxon
+from flask_nft_xumm.utils import decode_uri
+
+_unset = object()
+
+
+FIELDS = ("issuer", "id", "fee", "uri", "serial", "owner", "offer")
+_FIELDS = frozenset(FIELDS)
+
+
+@lru_cache(maxsize=1024)
+def _issuer(account_id):
+    # A page of listings is mostly a few artists' tokens
+    return encode_classic_address(bytes.fromhex(account_id))
+
+
+class NFTListing:
+    # issuer, fee, serial and uri are only set once they're given or read,
+    # see __getattr__
+    __slots__ = FIELDS + ("_uri_hex", "_extra")
+
+    def __init__(
+        self,
+        id,
+        owner=None,
+        offer=None,
+        issuer=None,
+        fee=None,
+        serial=None,
+        uri=_unset,
+        uri_hex=None,
+        **extra,
+    ):
+        self.id = id
+        self.owner = owner
+        self.offer = offer
+        if issuer is not None:
+            self.issuer = issuer
+        if fee is not None:
+            self.fee = fee
+        if serial is not None:
+            self.serial = serial
+        if uri is not _unset:
+            self.uri = uri
+        self._uri_hex = uri_hex
+        self._extra = extra or None
+
+    def __getattr__(self, name):
+        # Only called for a field that hasn't been set yet
+        if name == "issuer":
+            value = _issuer(self.id[8:48])
+        elif name == "fee":
+            value = int(self.id[4:8], 16)
+        elif name == "serial":
+            value, _ = nft_serial_and_taxon(self.id)
+        elif name == "uri":
+            value = decode_uri(self._uri_hex)
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+    def keys(self):
+        return FIELDS + tuple(self._extra or ())
+
+    def __getitem__(self, key):
+        if key in _FIELDS:
+            return getattr(self, key)
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in _FIELDS or bool(self._extra and key in self._extra)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __eq__(self, other):
+        if isinstance(other, (NFTListing, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f"NFTListing(id={self.id!r}, owner={self.owner!r})"
@@ -3,9 +3,10 @@ import json
 from flask import (Blueprint, abort, current_app, redirect, render_template,
                    request, url_for)
 from flask_login import UserMixin, current_user, login_user
-from xrplpers.xumm.transactions import get_xumm_transaction, xumm_login
+from xrplpers.xumm.transactions import xumm_login
 
 from flask_nft_xumm.utils import XUMMWalletProxy, is_safe_url
+from flask_nft_xumm.webhook import payload_response, track_payload
 
 login = Blueprint("xumm", __name__, template_folder="templates")
 
@@ -23,8 +24,12 @@ class XUMMUser(UserMixin):
 @login.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
-        data = json.loads(request.json)
-        xumm_data = get_xumm_transaction(data["payload_uuidv4"])
+        data = request.json
+        if isinstance(data, str):
+            data = json.loads(data)
+        xumm_data = payload_response(data["payload_uuidv4"])
+        if not xumm_data["meta"]["signed"]:
+            return abort(403)
         user_id = xumm_data["application"]["issued_user_token"]
         user = XUMMUser(
             user_id,
@@ -41,9 +46,10 @@ def index():
 
             return redirect(next or url_for("index"))
     r = xumm_login()
+    track_payload(r, "login")
     return render_template(
         "login.html",
         qr=r["refs"]["qr_png"],
         url=r["next"]["always"],
-        ws=r["refs"]["websocket_status"],
+        payload=r["uuid"],
     )
@@ -0,0 +1,229 @@
+"""
+Versioned schema migrations for the sqlite database.
+
+The schema version lives in sqlite's `user_version` pragma. Each entry in
+`MIGRATIONS` takes the database from version N to N + 1 and is applied in a
+single transaction, so add new ones to the end and never edit old ones.
+Statements are split on ";", so keep them out of string literals. A step can
+also be a function taking the connection, for data that needs Python to fill.
+"""
+
+
+def _backfill_token_columns(con):
+    from xrplpers.nfts.entities import TokenID
+
+    rows = con.execute("select id, token_id from stock where issuer is null").fetchall()
+    for id, token_id in rows:
+        token = TokenID.from_hex(token_id)
+        con.execute(
+            "update stock set issuer = ?, transfer_fee = ? where id = ?",
+            (token.issuer_as_string, token.transfer_fee.value, id),
+        )
+
+
+def _backfill_serial_and_taxon(con):
+    from flask_nft_xumm.ledger import nft_serial_and_taxon
+
+    rows = con.execute("select id, token_id from stock where serial is null").fetchall()
+    con.executemany(
+        "update stock set serial = ?, taxon = ? where id = ?",
+        [(*nft_serial_and_taxon(token_id), id) for id, token_id in rows],
+    )
+
+
+MIGRATIONS = [
+    # 1: the original db_setup.py schema. IF NOT EXISTS so databases made by
+    # that script pick up from here.
+    """
+    create table if not exists stock (
+        token_id text, sale_offer text, signed integer, seller text
+    );
+    create table if not exists wallet_cache (
+        user_token varchar primary key, wallet_address varchar
+    );
+    """,
+    # 2: give stock a key, make sale_offer unique and cover the listing
+    # queries (signed = 1 [and seller = ?]) so they don't scan the table.
+    """
+    create table stock_new (
+        id integer primary key,
+        token_id text not null,
+        sale_offer text,
+        signed integer not null default 0,
+        seller text not null
+    );
+    insert into stock_new (token_id, sale_offer, signed, seller)
+        select token_id, sale_offer, coalesce(signed, 0), seller from stock
+        where sale_offer is null or rowid in (
+            select max(rowid) from stock where sale_offer is not null
+            group by sale_offer
+        );
+    drop table stock;
+    alter table stock_new rename to stock;
+    create unique index stock_sale_offer on stock (sale_offer);
+    create index stock_signed_seller on stock (signed, seller, token_id, sale_offer);
+    """,
+    # 3: filterable listing columns, and indexes that keep the listing queries
+    # in id order (sqlite appends the rowid to every index) for keyset paging.
+    # These replace migration 2's covering index: listings are now read with
+    # every column, a page (or a wallet's worth) at a time, so covering them
+    # would mean a second copy of the table; looking up a page's rows by id
+    # costs far less (see test/stock_benchmark.py).
+    """
+    alter table stock add column issuer text;
+    alter table stock add column transfer_fee integer;
+    alter table stock add column price integer;
+    drop index stock_signed_seller;
+    create index stock_signed on stock (signed);
+    create index stock_signed_seller on stock (signed, seller);
+    create index stock_signed_issuer on stock (signed, issuer);
+    """,
+    # 4: fill issuer & transfer_fee in from the token ids already listed
+    _backfill_token_columns,
+    # 5: the local copy of ledger state kept by flask_nft_xumm.mirror
+    """
+    create table nft_owner (
+        token_id text primary key,
+        owner text not null,
+        uri text,
+        ledger_index integer
+    );
+    create index nft_owner_owner on nft_owner (owner);
+    create table sell_offer (
+        offer_id text primary key,
+        token_id text not null,
+        owner text not null,
+        amount text not null,
+        destination text,
+        flags integer not null default 1,
+        ledger_index integer
+    );
+    create index sell_offer_token on sell_offer (token_id);
+    create index sell_offer_owner on sell_offer (owner);
+    """,
+    # 6: when each listing was created & last checked against the ledger, see
+    # flask_nft_xumm.reconcile
+    """
+    alter table stock add column created_at integer;
+    alter table stock add column checked_at integer;
+    create index stock_pending on stock (signed, created_at);
+    """,
+    # 7: the rest of the token's metadata, so listings can be shown without
+    # parsing token ids or fetching the seller's NFTs
+    """
+    alter table stock add column taxon integer;
+    alter table stock add column serial integer;
+    alter table stock add column uri text;
+    """,
+    # 8: serial & taxon can be worked out from the token id, the URI is filled
+    # in by the shop the first time it looks the token up
+    _backfill_serial_and_taxon,
+    # 9: brokered sales waiting to be (or already) settled on the ledger, see
+    # flask_nft_xumm.settlement
+    """
+    create table settlement (
+        id integer primary key,
+        payload_uuid text not null unique,
+        nft_id text not null,
+        buyer text not null,
+        seller text not null,
+        sell_offer text not null,
+        amount text not null,
+        state text not null default 'queued',
+        attempts integer not null default 0,
+        next_attempt_at integer not null,
+        tx_hash text,
+        tx_blob text,
+        result text,
+        error text,
+        created_at integer not null,
+        updated_at integer not null
+    );
+    create index settlement_due on settlement (state, next_attempt_at);
+    """,
+    # 10: sequence numbers and tickets handed out to the marketplace wallet's
+    # transactions, see flask_nft_xumm.signer
+    """
+    create table account_sequence (
+        account text primary key,
+        next_sequence integer not null
+    );
+    create table ticket (
+        account text not null,
+        ticket_sequence integer not null,
+        claimed_at integer,
+        primary key (account, ticket_sequence)
+    );
+    """,
+    # 11: the XUMM payloads the app has asked users to sign, and what became
+    # of them, see flask_nft_xumm.webhook
+    """
+    create table xumm_payload (
+        uuid text primary key,
+        kind text not null,
+        account text,
+        context text,
+        resolved integer not null default 0,
+        signed integer,
+        txid text,
+        user_token text,
+        created_at integer not null,
+        resolved_at integer
+    );
+    """,
+    # 12: the sequence numbers the marketplace wallet has signed transactions
+    # with that haven't been validated or given up on yet, see
+    # flask_nft_xumm.signer
+    """
+    create table sequence_in_flight (
+        account text not null,
+        sequence integer not null,
+        claimed_at integer not null,
+        primary key (account, sequence)
+    );
+    """,
+    # 13: look up the payload or settlement a transaction belongs to, see
+    # flask_nft_xumm.transactions
+    """
+    create index xumm_payload_txid on xumm_payload (txid);
+    create index settlement_tx_hash on settlement (tx_hash);
+    """,
+    # 14: nothing shows a listing's taxon, the shop reads issuer,
+    # transfer_fee, serial & uri
+    """
+    alter table stock drop column taxon;
+    """,
+]
+
+
+def schema_version(con):
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(con, target=None):
+    """Bring the database on `con` up to `target` (default: the latest
+    version), returning the version it ends up at.
+
+    Safe to call from several workers at once: each step takes the write lock
+    and re-reads the version before applying anything.
+    """
+    target = len(MIGRATIONS) if target is None else target
+    while True:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            version = schema_version(con)
+            if version >= target:
+                con.rollback()
+                return version
+            step = MIGRATIONS[version]
+            if callable(step):
+                step(con)
+            else:
+                for statement in step.split(";"):
+                    if statement.strip():
+                        con.execute(statement)
+            con.execute(f"PRAGMA user_version = {version + 1}")
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
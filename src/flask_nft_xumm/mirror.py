@@ -0,0 +1,287 @@
+"""
+A local copy of the ledger state the marketplace cares about: who owns which
+NFTs, and the open sell offers on them.
+
+A background thread subscribes to the transaction stream for every seller and
+issuer in `stock` (plus the marketplace account), seeds the mirror from the
+ledger, then keeps it current from the metadata of each validated
+NFTokenMint, NFTokenCreateOffer, NFTokenAcceptOffer and NFTokenCancelOffer.
+
+`LedgerMirror.apply` takes a single stream message, and `LedgerMirror.run` any
+iterable of them, so the mirror can be driven from a list of canned messages
+as easily as from a live `WebsocketClient`.
+"""
+import itertools
+import os
+import threading
+import time
+
+from flask import current_app
+from xrpl.clients import WebsocketClient
+from xrpl.core.addresscodec import encode_classic_address
+from xrpl.models.requests import AccountNFTs, Subscribe
+
+from flask_nft_xumm import db
+from flask_nft_xumm.ledger import MAX_IN_FLIGHT, OfferLookup, resolve_sell_offers
+from flask_nft_xumm.transactions import remember_stream_message
+from flask_nft_xumm.utils import invalidate_account, wallet_data_cache
+
+WATCHED_TRANSACTIONS = {
+    "NFTokenMint",
+    "NFTokenCreateOffer",
+    "NFTokenAcceptOffer",
+    "NFTokenCancelOffer",
+    "NFTokenBurn",
+}
+
+# How often (in seconds) to look for new sellers & issuers to subscribe to
+REFRESH_INTERVAL = 30
+
+SELL_OFFER_FLAG = 1
+
+
+def _page_tokens(fields):
+    return {
+        t["NFToken"]["NFTokenID"]: t["NFToken"].get("URI")
+        for t in (fields or {}).get("NFTokens", [])
+    }
+
+
+def transaction_changes(message):
+    """Work out what a validated transaction did to offers and ownership from
+    its metadata.
+
+    Returns `(created_offers, deleted_offer_ids, owners, disowned)`, where
+    `owners` maps token id to `(owner, uri)` for every NFT that landed in an
+    account and `disowned` are tokens that left one without landing anywhere
+    (i.e. were burnt).
+    """
+    created, deleted = [], []
+    added, removed = {}, set()
+    for node in message["meta"].get("AffectedNodes", []):
+        ((kind, change),) = node.items()
+        entry_type = change.get("LedgerEntryType")
+        if entry_type == "NFTokenOffer":
+            if kind == "CreatedNode":
+                fields = change["NewFields"]
+                if int(fields.get("Flags", 0)) & SELL_OFFER_FLAG:
+                    offer = {
+                        "nft_offer_index": change["LedgerIndex"],
+                        "nft_id": fields["NFTokenID"],
+                        "owner": fields["Owner"],
+                        "amount": fields["Amount"],
+                        "flags": int(fields.get("Flags", 0)),
+                    }
+                    if fields.get("Destination"):
+                        offer["destination"] = fields["Destination"]
+                    created.append(offer)
+            elif kind == "DeletedNode":
+                deleted.append(change["LedgerIndex"])
+        elif entry_type == "NFTokenPage":
+            # The first 20 bytes of a page's index are its owner's account id
+            owner = encode_classic_address(bytes.fromhex(change["LedgerIndex"][:40]))
+            if kind == "CreatedNode":
+                before, after = {}, _page_tokens(change.get("NewFields"))
+            elif kind == "DeletedNode":
+                before = _page_tokens(
+                    change.get("PreviousFields") or change.get("FinalFields")
+                )
+                after = {}
+            else:
+                after = _page_tokens(change.get("FinalFields"))
+                previous = change.get("PreviousFields", {})
+                before = _page_tokens(previous) if "NFTokens" in previous else after
+            for token_id in after.keys() - before.keys():
+                added[token_id] = (owner, after[token_id])
+            removed.update(before.keys() - after.keys())
+    return created, deleted, added, removed - added.keys()
+
+
+class LedgerMirror:
+    def __init__(self):
+        self.ready = threading.Event()
+        self.watched = set()
+        # Tokens whose sell offers are all known: loaded by `seed`, or minted
+        # since. Offers made on anything else before the subscription
+        # started aren't in the mirror.
+        self.seeded = set()
+        self.ledger_index = None
+        self.applied = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_running(self, app):
+        """Follow the ledger in a daemon thread, unless this process already
+        is. Threads don't survive a fork, so what a parent's thread had
+        loaded isn't trusted either: the new thread seeds its own."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.ready.clear()
+            self.watched.clear()
+            self.seeded.clear()
+
+            def accounts():
+                return db.stock_accounts() | {app.creds["address"]}
+
+            threading.Thread(
+                target=self.subscribe,
+                args=(app.config.ledger_urls, accounts),
+                kwargs={"logger": app.logger.getChild("mirror")},
+                name="ledger-mirror",
+                daemon=True,
+            ).start()
+
+    def apply(self, message):
+        """Apply one transaction stream message, returning True if it changed
+        the mirror."""
+        if message.get("type") != "transaction" or not message.get("validated"):
+            return False
+        # Whatever it did, anyone waiting on it needn't ask the ledger
+        remember_stream_message(message)
+        if message["meta"].get("TransactionResult") != "tesSUCCESS":
+            return False
+        if message["transaction"].get("TransactionType") not in WATCHED_TRANSACTIONS:
+            return False
+        created, deleted, owners, disowned = transaction_changes(message)
+        if message["transaction"]["TransactionType"] == "NFTokenMint":
+            # Nothing can have offered a token before it existed
+            self.seeded.update(owners)
+        db.mirror_update(
+            created, deleted, owners, disowned, ledger_index=message.get("ledger_index")
+        )
+        # Catches trades made outside the marketplace, which send no signals
+        touched = {message["transaction"]["Account"]}
+        touched.update(owner for owner, _ in owners.values())
+        touched.update(offer["owner"] for offer in created)
+        for account in touched:
+            invalidate_account(account)
+        self.ledger_index = message.get("ledger_index", self.ledger_index)
+        self.applied += 1
+        return True
+
+    def run(self, messages):
+        for message in messages:
+            self.apply(message)
+
+    def seed(self, client, accounts, max_in_flight=MAX_IN_FLIGHT):
+        """Load the current state for `accounts` from the ledger: what they
+        own and the sell offers on everything they have in stock."""
+        for account in accounts:
+            nfts, marker = [], None
+            while True:
+                page = client.request(
+                    AccountNFTs(account=account, limit=400, marker=marker)
+                ).result
+                nfts.extend(
+                    (n["NFTokenID"], n.get("URI")) for n in page.get("account_nfts", [])
+                )
+                marker = page.get("marker")
+                if not marker:
+                    break
+            db.mirror_replace_owned(account, nfts)
+            token_ids = [row.token_id for row in db.stock_signed(seller=account)]
+            for lookup in resolve_sell_offers(token_ids, client, max_in_flight):
+                if not lookup.error:
+                    db.mirror_replace_offers(lookup.nft_id, lookup.offers)
+                    self.seeded.add(lookup.nft_id)
+        self.watched.update(accounts)
+
+    def watching(self, account):
+        """Whether the mirror is being kept up to date for `account`."""
+        return self.ready.is_set() and account in self.watched
+
+    def covers(self, nft_id, owner=None):
+        """Whether the mirror knows every sell offer on `nft_id`: it was
+        seeded, or minted since, and its owner is being watched."""
+        return nft_id in self.seeded and self.watching(owner or db.mirror_owner(nft_id))
+
+    def sell_offers(self, nft_ids):
+        offers = db.mirror_sell_offers(nft_ids)
+        return [OfferLookup(n, offers[n], None) for n in nft_ids]
+
+    def subscribe(self, urls, accounts, refresh=REFRESH_INTERVAL, logger=None):
+        """Follow the ledger at `urls` forever, watching whatever `accounts()`
+        returns (re-checked every `refresh` seconds) and reconnecting, to the
+        next of `urls`, if the connection drops."""
+        urls = itertools.cycle([urls] if isinstance(urls, str) else urls)
+        while True:
+            url = next(urls)
+            try:
+                with WebsocketClient(url, timeout=refresh) as client:
+                    self._follow(client, accounts, refresh)
+            except Exception:
+                if logger:
+                    logger.exception("Ledger mirror subscription failed")
+            self.ready.clear()
+            self.watched.clear()
+            self.seeded.clear()
+            time.sleep(refresh / 10)
+
+    def _follow(self, client, accounts, refresh):
+        while client.is_open():
+            new = set(accounts()) - self.watched
+            if new:
+                # Subscribe before seeding so nothing between the two is lost;
+                # replaying a change the seed already has is harmless.
+                client.request(Subscribe(accounts=sorted(new)))
+                self.seed(client, new)
+            self.ready.set()
+            checked = time.monotonic()
+            # Iterating stops by itself after `refresh` seconds of quiet, or
+            # when the connection closes
+            for message in client:
+                self.apply(message)
+                if time.monotonic() - checked > refresh:
+                    break
+
+
+def start_ledger_mirror(app):
+    """Start following the ledger in a daemon thread, returning the mirror,
+    see `LedgerMirror.ensure_running`."""
+    mirror = LedgerMirror()
+    mirror.ensure_running(app)
+    return mirror
+
+
+def sell_offers_for(nft_ids, client, owners=None, max_in_flight=MAX_IN_FLIGHT):
+    """Sell offers for `nft_ids`, like `ledger.resolve_sell_offers`, but read
+    from the ledger mirror for every token it covers; the rest (e.g. tokens a
+    watched owner holds but hasn't stocked) are asked of the ledger."""
+    nft_ids = list(nft_ids)
+    owners = list(owners) if owners else [None] * len(nft_ids)
+    mirror = getattr(current_app, "ledger_mirror", None)
+    if mirror is None:
+        local = set()
+    else:
+        local = {n for n, o in zip(nft_ids, owners) if mirror.covers(n, o)}
+    results = {}
+    if local:
+        results.update((l.nft_id, l) for l in mirror.sell_offers(list(local)))
+    remote = [n for n in nft_ids if n not in local]
+    if remote:
+        results.update(
+            (l.nft_id, l) for l in resolve_sell_offers(remote, client, max_in_flight)
+        )
+    return [results[n] for n in nft_ids]
+
+
+def listed_offers(address, client, cached_only=False):
+    """The open sell offer ids, by token id, on the NFTs `address` has listed
+    in the shop, cached with the rest of its wallet. With `cached_only`, None
+    unless they're already cached."""
+    key = ("sell_offers", address)
+    offers = wallet_data_cache.get(key)
+    if offers is not None or cached_only:
+        return offers
+    token_ids = [row.token_id for row in db.stock_signed(seller=address)]
+    lookups = sell_offers_for(token_ids, client, owners=[address] * len(token_ids))
+    offers = {}
+    for lookup in lookups:
+        offers.setdefault(lookup.nft_id, []).extend(
+            o["nft_offer_index"] for o in lookup.offers if o["owner"] == address
+        )
+    if not any(lookup.error for lookup in lookups):
+        wallet_data_cache.set(key, offers)
+    return offers
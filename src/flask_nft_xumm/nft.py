@@ -1,10 +1,37 @@
-from flask import Blueprint, current_app
+"""
+Implements two endpoints:
+
+GET /nft/$NAME - a page only holders of the NFT at that URL can see
+GET /nft/media/$NFT_ID/$FILENAME - a file only holders of the NFT can fetch
+
+Media files live in `<"path">/<nft id>/` under the `"media"` entry in
+`creds.json`. The first request for an NFT's media checks the wallet with
+`nft_required` and hands back a grant, a signed cookie (or `?grant=`) good for
+`"grant_ttl"` seconds, so the range requests a player goes on to make skip
+the wallet lookup. Files are sent with Range support, by the WSGI server's
+`sendfile` where it has one, or handed to the web server with `"x_sendfile":
+true` (Apache, lighttpd) or `"accel_redirect": "/internal/prefix/"` (nginx).
+"""
+import mimetypes
+from urllib.parse import quote
+
+from flask import Blueprint, abort, current_app, jsonify, request, send_from_directory
 from flask_login import current_user, login_required
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.security import safe_join
 
-from flask_nft_xumm.decorators import nft_required
+from flask_nft_xumm.decorators import NFTAccessDenied, nft_required
 
 nft = Blueprint("nft", __name__, template_folder="templates")
 
+GRANT_TTL = 600
+GRANT_COOKIE = "nft_media_grant"
+
+
+@nft.errorhandler(NFTAccessDenied)
+def access_denied(e):
+    return jsonify(e.to_dict()), e.status_code
+
 
 @nft.route("/<name>")
 @login_required
@@ -12,3 +39,74 @@ nft = Blueprint("nft", __name__, template_folder="templates")
 def index(name):
     current_app.logger.debug(f"Serving an NFT from {current_user}")
     return f"This am an NFT called {name} dawg! {current_user.is_authenticated}"
+
+
+def _media_config():
+    return current_app.creds.get("media", {})
+
+
+def _grants():
+    return URLSafeTimedSerializer(current_app.secret_key, salt="nft-media")
+
+
+def issue_grant(nft_id):
+    """A grant for the current user to fetch `nft_id`'s media."""
+    return _grants().dumps({"user": current_user.get_id(), "nft": nft_id})
+
+
+def check_grant(grant, nft_id):
+    """Whether `grant` lets the current user fetch `nft_id`'s media."""
+    if not grant:
+        return False
+    try:
+        granted = _grants().loads(
+            grant, max_age=_media_config().get("grant_ttl", GRANT_TTL)
+        )
+    except BadSignature:
+        return False
+    return granted == {"user": current_user.get_id(), "nft": nft_id}
+
+
+def _send_media(nft_id, filename):
+    config = _media_config()
+    path = safe_join("", nft_id, filename)
+    if "path" not in config or path is None:
+        abort(404)
+    if config.get("accel_redirect"):
+        # nginx serves the file, ranges and all
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        )
+        response.headers["X-Accel-Redirect"] = (
+            config["accel_redirect"].rstrip("/") + "/" + quote(path)
+        )
+        return response
+    # Answers Range requests, and uses sendfile (or X-Sendfile) where it can
+    return send_from_directory(config["path"], path)
+
+
+@nft_required
+def _send_to_owner(nft_id, filename):
+    grant = issue_grant(nft_id)
+    response = _send_media(nft_id, filename)
+    response.set_cookie(
+        GRANT_COOKIE,
+        grant,
+        max_age=_media_config().get("grant_ttl", GRANT_TTL),
+        # Good for every file of this NFT
+        path=request.path[: len(request.path) - len(filename)],
+        secure=request.is_secure,
+        httponly=True,
+        samesite="Lax",
+    )
+    response.headers["X-Media-Grant"] = grant
+    return response
+
+
+@nft.route("/media/<nft_id>/<path:filename>")
+@login_required
+def media(nft_id, filename):
+    grant = request.args.get("grant") or request.cookies.get(GRANT_COOKIE)
+    if check_grant(grant, nft_id):
+        return _send_media(nft_id, filename)
+    return _send_to_owner(nft_id, filename)
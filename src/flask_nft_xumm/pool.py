@@ -0,0 +1,248 @@
+"""
+A pool of ledger connections spread over several rippled servers.
+
+`LedgerClientPool` stands in for a single sync xrpl client: it has `request`,
+`request_impl` and a no-op `open`, so views and the xrpl helper functions can
+use it as they did `WebsocketClient`. Each request goes to the healthy server
+with the lowest recent latency, round robin over that server's connections,
+and moves on to the next server if it fails or takes longer than `timeout`.
+
+A background thread checks every server with `server_info` every
+`health_interval` seconds. Connections and the health thread belong to the
+process that made them; after a fork the pool starts afresh, so each gunicorn
+worker gets its own.
+"""
+import itertools
+import os
+import threading
+import time
+from asyncio import run_coroutine_threadsafe
+from concurrent.futures import TimeoutError
+
+from xrpl.clients import WebsocketClient
+from xrpl.models.requests import ServerInfo
+
+HEALTHY_STATES = {"full", "proposing", "validating"}
+
+# Weight given to the newest latency sample
+LATENCY_WEIGHT = 0.2
+
+
+class LedgerUnavailable(Exception):
+    pass
+
+
+def _request(client, request, timeout):
+    if isinstance(client, WebsocketClient):
+        # WebsocketClient.request waits forever on a dead server, so wait on
+        # its event loop ourselves. `Endpoint.client` has opened it.
+        future = run_coroutine_threadsafe(
+            client._do_request_impl(request), client._loop
+        )
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+    return client.request(request)
+
+
+def _close(client):
+    try:
+        client.close()
+    except Exception:
+        pass
+
+
+class Endpoint:
+    def __init__(self, url, size, client_factory):
+        self.url = url
+        self.size = size
+        self.client_factory = client_factory
+        self.latency = None
+        self.healthy = True
+        self.failures = 0
+        self.retry_at = 0
+        # Connections are made in the process that uses them; a pool made
+        # before a fork builds new endpoints rather than sharing these
+        self.clients = [client_factory(url) for _ in range(size)]
+        self._next = itertools.cycle(range(size))
+        self._lock = threading.Lock()
+
+    def client(self):
+        """The next connection, round robin, opened if it isn't yet.
+        WebsocketClient.open isn't safe to call from several threads at
+        once, so it's only called with the endpoint's lock held."""
+        with self._lock:
+            i = next(self._next)
+            client = self.clients[i]
+            if isinstance(client, WebsocketClient) and not client.is_open():
+                try:
+                    client.open()
+                except Exception:
+                    # Don't leave a half open connection in the pool
+                    self.clients[i] = self.client_factory(self.url)
+                    raise
+            return client
+
+    def close(self):
+        with self._lock:
+            clients = list(self.clients)
+        for client in clients:
+            _close(client)
+
+    def record(self, elapsed):
+        self.latency = (
+            elapsed
+            if self.latency is None
+            else LATENCY_WEIGHT * elapsed + (1 - LATENCY_WEIGHT) * self.latency
+        )
+        self.healthy = True
+        self.failures = 0
+
+    def fail(self, backoff, client=None):
+        """Mark the server down for a while, replacing `client`, the
+        connection that failed, if there is one. The others may be midway
+        through requests of their own, so they're left alone."""
+        with self._lock:
+            self.failures += 1
+            self.healthy = False
+            self.retry_at = time.monotonic() + min(
+                backoff * 2 ** (self.failures - 1), 300
+            )
+            for i, held in enumerate(self.clients):
+                if client is not None and held is client:
+                    self.clients[i] = self.client_factory(self.url)
+                    break
+            else:
+                client = None
+        if client is not None:
+            _close(client)
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "latency": self.latency,
+            "failures": self.failures,
+        }
+
+
+class LedgerClientPool:
+    def __init__(
+        self,
+        urls,
+        size=2,
+        timeout=10,
+        health_interval=30,
+        backoff=1,
+        client_factory=WebsocketClient,
+    ):
+        if isinstance(urls, str):
+            urls = [urls]
+        self.urls = list(urls)
+        self.size = size
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.backoff = backoff
+        self.client_factory = client_factory
+        self._pid = None
+        self._lock = threading.Lock()
+        self._ensure_process()
+
+    @property
+    def url(self):
+        return self.ranked()[0].url
+
+    def _ensure_process(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.endpoints = [
+                Endpoint(url, self.size, self.client_factory) for url in self.urls
+            ]
+            if self.health_interval:
+                threading.Thread(
+                    target=self._health_loop, name="ledger-health", daemon=True
+                ).start()
+            self._pid = os.getpid()
+
+    def ranked(self):
+        """Endpoints in the order to try them: healthy ones fastest first,
+        then unhealthy ones that are due a retry, soonest due first."""
+        self._ensure_process()
+        now = time.monotonic()
+        healthy = [e for e in self.endpoints if e.healthy]
+        healthy.sort(key=lambda e: float("inf") if e.latency is None else e.latency)
+        retry = [e for e in self.endpoints if not e.healthy and e.retry_at <= now]
+        waiting = sorted(
+            (e for e in self.endpoints if not e.healthy and e.retry_at > now),
+            key=lambda e: e.retry_at,
+        )
+        # Never give up entirely, the least recently failed server is better
+        # than nothing
+        return healthy + sorted(retry, key=lambda e: e.retry_at) + waiting
+
+    def request(self, request):
+        errors = []
+        for endpoint in self.ranked():
+            started = time.monotonic()
+            client = None
+            try:
+                client = endpoint.client()
+                response = _request(client, request, self.timeout)
+            except Exception as e:
+                endpoint.fail(self.backoff, client)
+                errors.append(f"{endpoint.url}: {e!r}")
+                continue
+            endpoint.record(time.monotonic() - started)
+            return response
+        raise LedgerUnavailable("; ".join(errors))
+
+    async def request_impl(self, request):
+        # What the xrpl helper functions (get_account_info etc.) call. They
+        # run on a throwaway event loop, so blocking here is fine.
+        return self.request(request)
+
+    def open(self):
+        """Connections are opened as they're used, this is for the callers
+        that expect a single client."""
+        self._ensure_process()
+
+    def is_open(self):
+        return True
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.close()
+
+    def check(self):
+        """Ask every server for its state, updating health and latency."""
+        for endpoint in list(self.endpoints):
+            started = time.monotonic()
+            client = None
+            try:
+                client = endpoint.client()
+                info = _request(client, ServerInfo(), self.timeout).result
+                state = info["info"]["server_state"]
+            except Exception:
+                endpoint.fail(self.backoff, client)
+                continue
+            if state in HEALTHY_STATES:
+                endpoint.record(time.monotonic() - started)
+            else:
+                endpoint.healthy = False
+
+    def _health_loop(self):
+        pid = os.getpid()
+        while self._pid in (None, pid):
+            self.check()
+            time.sleep(self.health_interval)
+            if self._pid not in (None, pid):
+                # We're a leftover from before a fork
+                return
+
+    def stats(self):
+        return [e.stats() for e in self.endpoints]
@@ -0,0 +1,80 @@
+"""
+Warms a wallet's caches in the background as its owner logs in.
+
+Logging in redirects straight to a page that wants the wallet's NFTs and
+account info, and `/wallet` its listed offers too. `WalletPrefetcher` starts
+loading all three into `wallet_data_cache` as soon as the login is accepted,
+on a small pool of worker threads, so they're usually there (or on their way,
+in which case the page's own fetch carries on from what's been loaded) by the
+time the page asks.
+
+At most `workers` wallets are fetched at once and `max_pending` queued; a
+login beyond that just isn't prefetched. A wallet already queued isn't queued
+again.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_nft_xumm.mirror import listed_offers
+from flask_nft_xumm.utils import XUMMWalletProxy
+
+PREFETCH_WORKERS = 2
+MAX_PENDING = 32
+
+
+class WalletPrefetcher:
+    def __init__(self, app, workers=PREFETCH_WORKERS, max_pending=MAX_PENDING):
+        self.app = app
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = set()
+        self.prefetched = self.skipped = self.failed = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    @property
+    def pool(self):
+        """This process's pool; threads don't survive a fork."""
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="prefetch"
+            )
+            self._pid = os.getpid()
+            self.pending = set()
+        return self._pool
+
+    def submit(self, address):
+        """Queue `address` to be prefetched, returning False if it wasn't."""
+        with self._lock:
+            pool = self.pool
+            if address in self.pending or len(self.pending) >= self.max_pending:
+                self.skipped += 1
+                return False
+            self.pending.add(address)
+        pool.submit(self._prefetch, address)
+        return True
+
+    def _prefetch(self, address):
+        logger = self.app.logger.getChild("prefetch")
+        try:
+            with self.app.app_context():
+                wallet = XUMMWalletProxy(address)
+                wallet.account_data
+                wallet.nfts
+                listed_offers(address, self.app.xrpl_client)
+            self.prefetched += 1
+        except Exception:
+            self.failed += 1
+            logger.exception(f"Prefetching {address} failed")
+        finally:
+            with self._lock:
+                self.pending.discard(address)
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "prefetched": self.prefetched,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
@@ -0,0 +1,160 @@
+"""
+Keeps the `stock` table in step with the ledger, off the request path.
+
+Every `interval` seconds a background thread checks each signed listing
+against the ledger's sell offers for its token. Listings whose offer has gone
+(accepted or cancelled elsewhere) are removed, the rest have their price and
+`checked_at` time refreshed, sell offers on stocked tokens that the table
+doesn't know about are imported (if the marketplace can broker them, see
+`importable_offers`), and listings that were never signed are dropped once
+they are `pending_ttl` seconds old.
+
+The shop then shows a listing checked within the last two intervals straight
+from the table, and only asks the ledger about the rest.
+"""
+import os
+import threading
+import time
+from collections import defaultdict
+
+from flask_nft_xumm import db
+from flask_nft_xumm.ledger import MAX_IN_FLIGHT, holds_nft, resolve_sell_offers
+from flask_nft_xumm.utils import cache_offer_to_db
+
+RECONCILE_INTERVAL = 60
+PENDING_TTL = 24 * 60 * 60
+
+
+def _price(offer):
+    # Only XRP (drops, as a string) prices are stored, IOU amounts are dicts
+    amount = offer.get("amount")
+    return int(amount) if isinstance(amount, str) else None
+
+
+def offer_from_row(row):
+    """A listing in the shape NFTSellOffers returns offers in."""
+    return {
+        "nft_offer_index": row.sale_offer,
+        "owner": row.seller,
+        "amount": str(row.price),
+        "flags": 1,
+    }
+
+
+def importable_offers(token_id, offers, client):
+    """Those of `offers` (as returned by NFTSellOffers for `token_id`) the
+    marketplace can broker: for XRP, open to anyone (no `Destination`) and
+    made by whoever holds the token now, rather than left over from a
+    previous owner."""
+    offers = [o for o in offers if _price(o) is not None and not o.get("destination")]
+    holders = {
+        owner
+        for owner in {o["owner"] for o in offers}
+        if holds_nft(owner, token_id, client)
+    }
+    return [o for o in offers if o["owner"] in holders]
+
+
+def import_ledger_offers(token_id, offers, client, checked_at=None):
+    """Add those of `offers` (as returned by NFTSellOffers for `token_id`)
+    that aren't in `stock` yet, and that `importable_offers` allows, as
+    signed listings. Returns how many were imported."""
+    offers = importable_offers(token_id, offers, client)
+    for offer in offers:
+        cache_offer_to_db(
+            token_id,
+            offer["nft_offer_index"],
+            1,
+            offer["owner"],
+            price=_price(offer),
+            checked_at=checked_at,
+        )
+    return len(offers)
+
+
+def reconcile_stock(
+    client, now=None, pending_ttl=PENDING_TTL, max_in_flight=MAX_IN_FLIGHT
+):
+    """Check every signed listing against the ledger once, returning a dict
+    of how many rows were checked, removed and imported."""
+    now = int(now or time.time())
+    by_token = defaultdict(list)
+    for row in db.stock_signed():
+        by_token[row.token_id].append(row)
+    checked, stale, imported = [], [], 0
+    for lookup in resolve_sell_offers(list(by_token), client, max_in_flight):
+        if lookup.error:
+            # Leave the rows be, they'll be tried again next time
+            continue
+        live = {offer["nft_offer_index"]: offer for offer in lookup.offers}
+        for row in by_token[lookup.nft_id]:
+            offer = live.pop(row.sale_offer, None)
+            if offer is None:
+                stale.append(row.id)
+            else:
+                checked.append((row.id, _price(offer)))
+        if live:
+            imported += import_ledger_offers(
+                lookup.nft_id, live.values(), client, checked_at=now
+            )
+    db.stock_delete_ids(stale)
+    db.stock_mark_checked(checked, now)
+    pruned = db.stock_prune_unsigned(now - pending_ttl)
+    return {
+        "checked": len(checked),
+        "removed": len(stale),
+        "imported": imported,
+        "pruned": pruned,
+    }
+
+
+class StockReconciler:
+    def __init__(self, interval=RECONCILE_INTERVAL):
+        self.interval = interval
+        self.last_run = None
+        self.last_result = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_running(self, app):
+        """Start reconciling in a daemon thread, unless this process already
+        is; threads don't survive a fork."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(
+                target=self.run,
+                args=(app.xrpl_client,),
+                kwargs={"logger": app.logger.getChild("reconcile")},
+                name="stock-reconciler",
+                daemon=True,
+            ).start()
+
+    def trusts(self, row, now=None):
+        """Whether `row` was checked recently enough to list without asking
+        the ledger."""
+        if row.checked_at is None or row.price is None:
+            return False
+        return row.checked_at >= (now or time.time()) - 2 * self.interval
+
+    def run(self, client, logger=None):
+        while True:
+            started = time.monotonic()
+            try:
+                self.last_result = reconcile_stock(client)
+                self.last_run = time.time()
+                if logger:
+                    logger.debug(f"Reconciled stock: {self.last_result}")
+            except Exception:
+                if logger:
+                    logger.exception("Stock reconciliation failed")
+            time.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+
+def start_stock_reconciler(app, interval=RECONCILE_INTERVAL):
+    """Start reconciling the stock in a daemon thread, every `interval`
+    seconds, see `StockReconciler.ensure_running`."""
+    reconciler = StockReconciler(interval)
+    reconciler.ensure_running(app)
+    return reconciler
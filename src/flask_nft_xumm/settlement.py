@@ -0,0 +1,203 @@
+"""
+Settles brokered sales in the background, so `/buy` doesn't hold a worker
+while the accept waits for the ledger.
+
+Once the buyer has signed their offer, `/buy` queues a job in the
+`settlement` table, keyed on the XUMM payload they signed, and the page polls
+`/buy/status/$PAYLOAD` until the job is done. A `SettlementQueue` thread in
+each worker claims due jobs, finds the buy offer, signs an NFTokenAcceptOffer
+for it and the seller's offer with the marketplace wallet's
+`signer.MarketplaceSigner`, and submits it. Sales don't share a sequence
+number, so they settle side by side.
+
+The signed transaction is stored before it's submitted. If the worker dies or
+the submission errors, the next attempt looks that transaction up first and
+only signs a new one once the old one can no longer make it into a ledger,
+so a sale is never settled twice. Failed attempts are retried with backoff
+up to `MAX_ATTEMPTS` times.
+"""
+import os
+import threading
+import time
+
+from xrpl.core.binarycodec import decode, encode
+from xrpl.ledger import get_latest_validated_ledger_sequence
+from xrpl.models.requests import NFTSellOffers
+from xrpl.models.response import Response, ResponseStatus
+from xrpl.models.transactions import NFTokenAcceptOffer
+from xrpl.models.transactions.transaction import Transaction
+
+from flask_nft_xumm import db
+from flask_nft_xumm.trade import calculate_broker_fee, sale_completed
+from flask_nft_xumm.transactions import created_offer_id, find_transaction
+from flask_nft_xumm.webhook import payload_response
+
+# How often (in seconds) to look for due jobs when nothing wakes the queue
+SETTLE_INTERVAL = 5
+MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubling each time after that
+RETRY_BACKOFF = 5
+# A job left running this long (in seconds) was abandoned by its worker
+LEASE = 300
+
+
+class Unsettleable(Exception):
+    """The sale can't go ahead, and retrying won't change that."""
+
+
+def _previous_attempt(job, client):
+    """The validated outcome of the transaction an earlier attempt signed, the
+    transaction itself if it may still make it into a ledger, or None if it
+    never will.
+
+    The validated ledger is read before the transaction is looked up: if the
+    transaction wasn't in any ledger up to that one, and its
+    `LastLedgerSequence` is behind it, no later ledger can include it. A
+    lookup that fails (rather than finding nothing) raises, so the job is
+    retried instead of signing a second accept."""
+    validated_ledger = get_latest_validated_ledger_sequence(client)
+    # Not validated yet (txnNotFound included) is None; anything else raises
+    # TransactionLookupFailed
+    found = find_transaction(job.tx_hash, client)
+    if found is not None:
+        return Response(status=ResponseStatus.SUCCESS, result=found["tx"])
+    transaction = Transaction.from_xrpl(decode(job.tx_blob))
+    if validated_ledger > transaction.last_ledger_sequence:
+        return None
+    return transaction
+
+
+def _sign_accept(job, client, signer):
+    buy = payload_response(job.payload_uuid)
+    if buy["payload"]["request_json"]["NFTokenID"] != job.nft_id:
+        raise Unsettleable("The signed offer is for a different NFT")
+    # Raises TransactionNotValidated, and the job's retried, if it isn't yet
+    buy_offer = created_offer_id(buy["response"]["txid"], client)
+    if not buy_offer:
+        raise Unsettleable("The buyer's offer wasn't created")
+    sells = client.request(NFTSellOffers(nft_id=job.nft_id)).result.get("offers", [])
+    if not any(o["nft_offer_index"] == job.sell_offer for o in sells):
+        raise Unsettleable("The NFT is no longer for sale at that price")
+    accept = NFTokenAcceptOffer(
+        account=signer.account,
+        nftoken_broker_fee=calculate_broker_fee(job.amount),
+        nftoken_buy_offer=buy_offer,
+        nftoken_sell_offer=job.sell_offer,
+    )
+    transaction = signer.sign(accept)
+    db.settlement_signed(job.id, transaction.get_hash(), encode(transaction.to_xrpl()))
+    return transaction
+
+
+def settle(job, client, signer):
+    """Bring the offers for `job` together, returning the validated
+    transaction response."""
+    transaction = None
+    if job.tx_blob:
+        transaction = _previous_attempt(job, client)
+        if transaction is not None and not isinstance(transaction, Transaction):
+            return transaction
+    if transaction is None:
+        transaction = _sign_accept(job, client, signer)
+    return signer.submit(transaction)
+
+
+class SettlementQueue:
+    def __init__(
+        self, interval=SETTLE_INTERVAL, max_attempts=MAX_ATTEMPTS, lease=LEASE
+    ):
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self.wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_running(self, app):
+        """Start settling in a daemon thread, unless this process already
+        is; threads don't survive a fork."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(
+                target=self.run,
+                args=(app,),
+                kwargs={"logger": app.logger.getChild("settlement")},
+                name="settlement",
+                daemon=True,
+            ).start()
+
+    def enqueue(self, payload_uuid, nft_id, buyer, offer):
+        """Queue the sale of `nft_id` to `buyer` through the sell `offer` (as
+        NFTSellOffers returns it). Safe to call again for the same payload."""
+        job = db.settlement_enqueue(
+            payload_uuid,
+            nft_id,
+            buyer,
+            offer["owner"],
+            offer["nft_offer_index"],
+            offer["amount"],
+        )
+        self.wake.set()
+        return job
+
+    def process(self, job, app, logger=None):
+        with app.app_context():
+            try:
+                response = settle(job, app.xrpl_client, app.marketplace_signer)
+            except Unsettleable as e:
+                db.settlement_finish(job.id, "failed", error=str(e))
+                return
+            except Exception as e:
+                if logger:
+                    logger.exception(f"Settling {job.payload_uuid} failed")
+                if job.attempts >= self.max_attempts:
+                    db.settlement_finish(job.id, "failed", error=str(e))
+                else:
+                    retry_at = time.time() + RETRY_BACKOFF * 2 ** (job.attempts - 1)
+                    db.settlement_finish(
+                        job.id, "queued", error=str(e), next_attempt_at=int(retry_at)
+                    )
+                return
+            outcome = response.result["meta"]["TransactionResult"]
+            db.settlement_finish(
+                job.id,
+                "settled" if outcome == "tesSUCCESS" else "failed",
+                result=response.result,
+            )
+            if outcome != "tesSUCCESS":
+                # Nothing changed hands, the job's state says why
+                return
+            sale_completed.send(
+                app,
+                nft=job.nft_id,
+                sale=response,
+                accounts=[job.buyer, job.seller, app.creds["address"]],
+            )
+
+    def run_once(self, app, logger=None):
+        """Settle the next due job, if there is one, returning it."""
+        job = db.settlement_claim(self.lease)
+        if job is not None:
+            self.process(job, app, logger)
+        return job
+
+    def run(self, app, logger=None):
+        while True:
+            try:
+                if self.run_once(app, logger) is not None:
+                    continue
+            except Exception:
+                if logger:
+                    logger.exception("Settlement queue failed")
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+
+def start_settlement_queue(app, interval=SETTLE_INTERVAL):
+    """Start settling queued sales in a daemon thread, see
+    `SettlementQueue.ensure_running`."""
+    queue = SettlementQueue(interval)
+    queue.ensure_running(app)
+    return queue
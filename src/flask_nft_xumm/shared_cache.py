@@ -0,0 +1,428 @@
+"""
+Caches shared between worker processes.
+
+A `SharedCache` keeps a short lived, per-process `TTLCache` in front of a
+`CacheBackend` that every worker can see, so a wallet fetched by one gunicorn
+worker is a hit for the rest, and dropping an entry (or every entry tagged
+with an account) in one worker drops it for all of them; other workers'
+local copies last at most `local_ttl` seconds.
+
+Every write to the backend is stamped with a version. Once `local_ttl` is
+up the entry is read from the backend again, but only decoded (which for a
+wallet means rebuilding its `WalletIndex`) if its version has changed; until
+then the decoded copy this process already holds is used.
+
+Backends store bytes. Values are written as compact JSON, zlib compressed
+once they're over `COMPRESS_OVER` bytes, which suits the ledger data cached
+here and is safe to share with other hosts (unlike pickle).
+
+Three backends ship here:
+
+- `MemoryBackend`, per-process only, for tests and the development server.
+- `SQLiteBackend`, a sqlite file shared by every process on the host.
+- `NetworkBackend`, for several hosts, wrapping a redis-py style client.
+
+Pick one with the `"cache"` entry in `creds.json`, see `backend_from_config`.
+"""
+import importlib
+import json
+import os
+import threading
+import time
+import zlib
+
+from flask_nft_xumm import db
+from flask_nft_xumm.cache import TTLCache, _missing
+
+COMPRESS_OVER = 512
+
+_RAW = b"j"
+_COMPRESSED = b"z"
+# SharedCache entries start with this and a VERSION_SIZE byte version
+_VERSIONED = b"v"
+VERSION_SIZE = 16
+
+
+def dumps(value):
+    data = json.dumps(value, separators=(",", ":")).encode()
+    if len(data) > COMPRESS_OVER:
+        return _COMPRESSED + zlib.compress(data)
+    return _RAW + data
+
+
+def loads(data):
+    kind, data = data[:1], data[1:]
+    if kind == _COMPRESSED:
+        data = zlib.decompress(data)
+    elif kind != _RAW:
+        raise ValueError(f"Unknown cache encoding {kind!r}")
+    return json.loads(data)
+
+
+class CacheBackend:
+    """Storage for a `SharedCache`. Keys and tags are strings, values bytes.
+
+    Tags group entries so they can be dropped together, e.g. everything
+    cached about one account.
+    """
+
+    def get(self, key):
+        """The value for `key`, or None if it's missing or has expired."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl, tags=()):
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        raise NotImplementedError
+
+    def delete_tag(self, tag):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"backend": self.__class__.__name__}
+
+
+class MemoryBackend(CacheBackend):
+    def __init__(self, maxsize=4096):
+        self.entries = TTLCache(maxsize)
+        self.tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value, ttl, tags=()):
+        with self._lock:
+            self.entries.set(key, value, ttl)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+
+    def delete(self, *keys):
+        self.entries.invalidate(*keys)
+
+    def delete_tag(self, tag):
+        with self._lock:
+            self.entries.invalidate(*self.tags.pop(tag, ()))
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def stats(self):
+        return dict(super().stats(), **self.entries.stats())
+
+
+class SQLiteBackend(CacheBackend):
+    """Entries in a sqlite file, readable by every process on the host.
+
+    The file only ever holds cached data, so it's kept apart from the app's
+    database (no migrations, and cache writes don't queue behind stock
+    writes) and can be deleted at any time.
+    """
+
+    SCHEMA = (
+        "create table if not exists cache_entry "
+        "(key text primary key, value blob not null, expires real not null) "
+        "without rowid",
+        "create table if not exists cache_tag "
+        "(tag text not null, key text not null, primary key (tag, key)) "
+        "without rowid",
+    )
+
+    # Sweep out expired entries every this many writes
+    PURGE_EVERY = 1000
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("XUMM_CACHE_PATH", "xumm_cache.db")
+        self._local = threading.local()
+        self._writes = 0
+        self.connection()
+
+    def connection(self):
+        """The calling thread's connection, see `db.connection`."""
+        con = getattr(self._local, "con", None)
+        if con is None or self._local.pid != os.getpid():
+            con = self._local.con = db.connect(self.path)
+            self._local.pid = os.getpid()
+            with con:
+                for sql in self.SCHEMA:
+                    con.execute(sql)
+        return con
+
+    def get(self, key):
+        row = (
+            self.connection()
+            .execute(
+                "select value from cache_entry where key = ? and expires > ?",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def set(self, key, value, ttl, tags=()):
+        with self.connection() as con:
+            con.execute(
+                "insert into cache_entry (key, value, expires) values (?, ?, ?) "
+                "on conflict (key) do update set "
+                "value = excluded.value, expires = excluded.expires",
+                (key, value, time.time() + ttl),
+            )
+            con.executemany(
+                "insert or ignore into cache_tag (tag, key) values (?, ?)",
+                [(tag, key) for tag in tags],
+            )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def delete(self, *keys):
+        with self.connection() as con:
+            con.executemany(
+                "delete from cache_entry where key = ?", [(k,) for k in keys]
+            )
+            con.executemany("delete from cache_tag where key = ?", [(k,) for k in keys])
+
+    def delete_tag(self, tag):
+        with self.connection() as con:
+            con.execute(
+                "delete from cache_entry where key in "
+                "(select key from cache_tag where tag = ?)",
+                (tag,),
+            )
+            con.execute("delete from cache_tag where tag = ?", (tag,))
+
+    def purge(self):
+        with self.connection() as con:
+            con.execute("delete from cache_entry where expires <= ?", (time.time(),))
+            con.execute(
+                "delete from cache_tag where key not in (select key from cache_entry)"
+            )
+
+    def clear(self):
+        with self.connection() as con:
+            con.execute("delete from cache_entry")
+            con.execute("delete from cache_tag")
+
+    def stats(self):
+        (size,) = (
+            self.connection().execute("select count(*) from cache_entry").fetchone()
+        )
+        return dict(super().stats(), path=self.path, size=size)
+
+
+class NetworkBackend(CacheBackend):
+    """Entries in a network cache, for deployments over several hosts.
+
+    `client` is anything with redis-py's `get`, `set(key, value, ex=)`,
+    `delete`, `sadd`, `smembers`, `expire` and `scan_iter`, usually a
+    `redis.Redis`. Tags are kept as sets of keys, which outlive the entries in
+    them by up to `TAG_TTL` seconds.
+    """
+
+    TAG_TTL = 24 * 60 * 60
+
+    def __init__(self, client, prefix="xumm:"):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl, tags=()):
+        key = self.prefix + key
+        self.client.set(key, value, ex=max(1, int(ttl)))
+        for tag in tags:
+            tag = f"{self.prefix}tag:{tag}"
+            self.client.sadd(tag, key)
+            self.client.expire(tag, self.TAG_TTL)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def delete_tag(self, tag):
+        tag = f"{self.prefix}tag:{tag}"
+        self.client.delete(*self.client.smembers(tag), tag)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(f"{self.prefix}*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+def backend_from_config(config=None):
+    """Build the backend described by `config`, the `"cache"` entry in
+    `creds.json`:
+
+    - missing, or `{"backend": "sqlite", "path": ...}`: `SQLiteBackend`
+    - `{"backend": "memory"}`: `MemoryBackend`
+    - `{"backend": "redis", "url": ..., "prefix": ...}`: `NetworkBackend`
+      over `redis.Redis.from_url(url)`
+    - `{"backend": "package.module:factory", ...}`: whatever
+      `factory(**rest_of_config)` returns
+    """
+    config = dict(config or {})
+    kind = config.pop("backend", "sqlite")
+    if kind == "sqlite":
+        return SQLiteBackend(config.get("path"))
+    if kind == "memory":
+        return MemoryBackend(**config)
+    if kind == "redis":
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The redis cache backend needs: pip install redis")
+        return NetworkBackend(
+            redis.Redis.from_url(config["url"]), prefix=config.get("prefix", "xumm:")
+        )
+    module, _, name = kind.partition(":")
+    return getattr(importlib.import_module(module), name)(**config)
+
+
+_backend = MemoryBackend()
+
+
+def configure(backend):
+    """Use `backend` for every `SharedCache`, dropping what they hold
+    locally."""
+    global _backend
+    _backend = backend
+    for cache in SharedCache.instances:
+        cache.clear()
+
+
+class SharedCache:
+    """A `TTLCache` look-alike over the configured `CacheBackend`.
+
+    Keys are strings or tuples of them; `tags(key)` gives the tags to file
+    each entry under. `encode` and `decode` turn values that aren't plain
+    JSON into something that is, and back.
+    """
+
+    instances = []
+
+    def __init__(
+        self,
+        namespace,
+        ttl=60,
+        local_ttl=5,
+        maxsize=1024,
+        tags=None,
+        encode=None,
+        decode=None,
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = TTLCache(maxsize, min(ttl, local_ttl))
+        # key -> (version, value): the decoded values, kept for as long as
+        # the backend might hold them, see `get`
+        self.decoded = TTLCache(maxsize, ttl)
+        self.tags = tags or (lambda key: ())
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+        self.shared_hits = self.shared_misses = self.reused = 0
+        SharedCache.instances.append(self)
+
+    @property
+    def backend(self):
+        return _backend
+
+    def _key(self, key):
+        parts = key if isinstance(key, tuple) else (key,)
+        return ":".join((self.namespace, *map(str, parts)))
+
+    def get(self, key, default=None):
+        value = self.local.get(key, _missing)
+        if value is not _missing:
+            return value
+        data = self.backend.get(self._key(key))
+        if data is None:
+            self.shared_misses += 1
+            self.decoded.invalidate(key)
+            return default
+        version = None
+        if data[:1] == _VERSIONED:
+            version = data[1 : 1 + VERSION_SIZE]
+            data = data[1 + VERSION_SIZE :]
+        held = self.decoded.get(key)
+        if version is not None and held is not None and held[0] == version:
+            # Unchanged since this process decoded it
+            value = held[1]
+            self.reused += 1
+        else:
+            try:
+                value = self.decode(loads(data))
+            except (ValueError, zlib.error):
+                # Written by something else, or corrupt; treat it as a miss
+                self.shared_misses += 1
+                return default
+            self.decoded.set(key, (version, value))
+        self.shared_hits += 1
+        self.local.set(key, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        version = os.urandom(VERSION_SIZE // 2).hex().encode()
+        self.local.set(key, value, min(ttl, self.local.ttl))
+        self.decoded.set(key, (version, value), ttl)
+        self.backend.set(
+            self._key(key),
+            _VERSIONED + version + dumps(self.encode(value)),
+            ttl,
+            tags=self.tags(key),
+        )
+
+    def get_or_set(self, key, factory, force=False):
+        if not force:
+            value = self.get(key, _missing)
+            if value is not _missing:
+                return value
+        value = factory()
+        self.set(key, value)
+        return value
+
+    def version(self, key):
+        """The version of the entry for `key`, as this process holds it
+        (re-reading the backend once `local_ttl` is up), or None if there
+        isn't one."""
+        if self.get(key, _missing) is _missing:
+            return None
+        held = self.decoded.get(key)
+        return None if held is None or held[0] is None else held[0].decode()
+
+    def invalidate(self, *keys):
+        self.local.invalidate(*keys)
+        self.decoded.invalidate(*keys)
+        self.backend.delete(*[self._key(key) for key in keys])
+
+    def invalidate_tag(self, tag):
+        """Drop every entry filed under `tag`, in every process."""
+        self.local.invalidate_where(lambda key: tag in self.tags(key))
+        self.decoded.invalidate_where(lambda key: tag in self.tags(key))
+        self.backend.delete_tag(tag)
+
+    def memory_usage(self):
+        # The local copies are (almost always) among the decoded ones
+        return self.decoded.memory_usage()
+
+    def clear(self):
+        """Drop this process's copies, the backend keeps its entries."""
+        self.local.clear()
+        self.decoded.clear()
+
+    def stats(self):
+        return dict(
+            self.local.stats(),
+            ttl=self.ttl,
+            local_ttl=self.local.ttl,
+            shared_hits=self.shared_hits,
+            shared_misses=self.shared_misses,
+            reused=self.reused,
+        )
@@ -0,0 +1,185 @@
+"""
+Signs the marketplace wallet's transactions without asking the ledger first.
+
+`safe_sign_and_autofill_transaction` looks up the account's next sequence
+number and the network fee for every transaction, and two sales signed at
+once get the same sequence number, so one of them fails. `MarketplaceSigner`
+hands out sequence numbers from the `account_sequence` table instead (each
+one exactly once, across every worker), and caches the fee and the current
+ledger index for `fee_ttl` seconds.
+
+It can also keep a stock of XRPL Tickets (set `"tickets"` in `creds.json` to
+how many) and sign with those while there are some. Transactions using
+tickets go through in any order, and one that fails just gives its ticket
+back, rather than leaving a gap in the sequence that holds up everything
+signed after it until the signer resyncs with the ledger (which it only does
+once no other sequence numbers are in flight, see `release`).
+"""
+import threading
+import time
+
+from xrpl.account import get_next_valid_seq_number
+from xrpl.models.requests import AccountObjects, AccountObjectType, Fee
+from xrpl.models.transactions import TicketCreate
+from xrpl.transaction import safe_sign_transaction, send_reliable_submission
+from xrpl.utils import xrp_to_drops
+
+from flask_nft_xumm import db
+from flask_nft_xumm.cache import TTLCache
+from flask_nft_xumm.transactions import remember
+
+FEE_TTL = 10
+# The most we'll pay to get a transaction in, the same cap xrpl-py uses
+MAX_FEE = int(xrp_to_drops(2))
+# How many ledgers a signed transaction has to get into one
+LEDGER_MARGIN = 20
+# Roughly how often (in seconds) a ledger closes, to age the cached index
+LEDGER_CLOSE = 4
+# A ticket claimed this long ago (in seconds) whose transaction never made it
+# is free to use again
+TICKET_LEASE = 600
+# The most tickets an account can hold
+MAX_TICKETS = 250
+# A sequence number handed out this long ago (in seconds) is past its
+# transaction's last ledger sequence, so no longer in flight
+SEQUENCE_LEASE = 2 * LEDGER_MARGIN * LEDGER_CLOSE
+
+
+class MarketplaceSigner:
+    def __init__(self, wallet, client, tickets=0, fee_ttl=FEE_TTL, logger=None):
+        self.wallet = wallet
+        self.client = client
+        self.account = wallet.classic_address
+        self.tickets = min(tickets, MAX_TICKETS)
+        self.logger = logger
+        self._network = TTLCache(maxsize=1, ttl=fee_ttl)
+        self._refilling = threading.Lock()
+
+    def network(self):
+        """The fee to pay, in drops, and the current ledger index."""
+        fetched = self._network.get("fee")
+        if fetched is None:
+            result = self.client.request(Fee()).result
+            fee = min(int(result["drops"]["open_ledger_fee"]), MAX_FEE)
+            fetched = (fee, result["ledger_current_index"], time.monotonic())
+            self._network.set("fee", fetched)
+        fee, ledger_index, fetched_at = fetched
+        return fee, ledger_index + int((time.monotonic() - fetched_at) / LEDGER_CLOSE)
+
+    def resync(self):
+        """Start handing out sequence numbers from the ledger's next one."""
+        db.sequence_reset(
+            self.account, get_next_valid_seq_number(self.account, self.client)
+        )
+
+    def _sequence(self):
+        self._top_up_tickets()
+        ticket = db.ticket_claim(self.account)
+        if ticket is not None:
+            return {"sequence": 0, "ticket_sequence": ticket}
+        sequence = db.sequence_next(self.account)
+        if sequence is None:
+            self.resync()
+            sequence = db.sequence_next(self.account)
+        return {"sequence": sequence}
+
+    def sign(self, transaction):
+        """Fill in the account, fee, sequence (or ticket) and last ledger
+        sequence of `transaction` and sign it."""
+        fee, ledger_index = self.network()
+        filled = type(transaction).from_dict(
+            dict(
+                transaction.to_dict(),
+                account=self.account,
+                fee=str(fee),
+                last_ledger_sequence=ledger_index + LEDGER_MARGIN,
+                **self._sequence(),
+            )
+        )
+        # The fee's already capped at MAX_FEE, and the check would compare it
+        # to the unloaded network fee
+        return safe_sign_transaction(filled, self.wallet, check_fee=False)
+
+    def submit(self, transaction):
+        """Submit a transaction from `sign`, waiting for it to be validated."""
+        try:
+            response = send_reliable_submission(transaction, self.client)
+        except Exception:
+            # It didn't make it into a validated ledger, so its sequence
+            # number or ticket wasn't used. Not only
+            # XRPLReliableSubmissionException: xrpl-py's wait raises KeyError
+            # if the server it asks hasn't seen the transaction, and holding
+            # the sequence number until its lease runs out would hold up
+            # everything signed after it.
+            self.release(transaction)
+            raise
+        if transaction.ticket_sequence:
+            db.ticket_used(self.account, transaction.ticket_sequence)
+        else:
+            db.sequence_done(self.account, transaction.sequence)
+        if response.result.get("validated"):
+            remember(response.result)
+        return response
+
+    def release(self, transaction):
+        """Give back the sequence number or ticket of a transaction that will
+        never be validated."""
+        if transaction.ticket_sequence:
+            db.ticket_release(self.account, transaction.ticket_sequence)
+            return
+        # Nothing after the gap can go through until it's filled, but the
+        # ledger's next sequence is one that transactions still in flight
+        # may have been signed with. Leave the gap until they've all been
+        # validated or given up on (and so released in turn); the last one
+        # back resyncs.
+        stale_before = time.time() - SEQUENCE_LEASE
+        if db.sequence_release(self.account, transaction.sequence, stale_before):
+            return
+        db.sequence_resync(
+            self.account,
+            get_next_valid_seq_number(self.account, self.client),
+            stale_before,
+        )
+
+    def sync_tickets(self):
+        """Load the tickets the account holds from the ledger, freeing any
+        whose claim has lapsed."""
+        tickets, marker = [], None
+        while True:
+            page = self.client.request(
+                AccountObjects(
+                    account=self.account, type=AccountObjectType.TICKET, marker=marker
+                )
+            ).result
+            tickets.extend(o["TicketSequence"] for o in page.get("account_objects", []))
+            marker = page.get("marker")
+            if not marker:
+                break
+        db.ticket_replace(self.account, tickets, time.time() - TICKET_LEASE)
+        return tickets
+
+    def create_tickets(self, count):
+        transaction = self.sign(TicketCreate(account=self.account, ticket_count=count))
+        response = self.submit(transaction)
+        self.sync_tickets()
+        return response
+
+    def _top_up_tickets(self):
+        if not self.tickets or db.ticket_available(self.account) > self.tickets // 2:
+            return
+        if self._refilling.acquire(blocking=False):
+            threading.Thread(target=self._refill, name="tickets", daemon=True).start()
+
+    def _refill(self):
+        try:
+            held = len(self.sync_tickets())
+            wanted = min(
+                self.tickets - db.ticket_available(self.account), MAX_TICKETS - held
+            )
+            if wanted > 0:
+                self.create_tickets(wanted)
+        except Exception:
+            if self.logger:
+                self.logger.exception("Creating tickets failed")
+        finally:
+            self._refilling.release()
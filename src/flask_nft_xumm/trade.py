@@ -4,18 +4,24 @@ Implements four endpoints:
 GET /shop/$OWNER - lists all NFTs for sale from a given owner
 GET /shop/$ISSUER - lists all NFTs for sale from a given issuer, regardless of owner
 
-GET /sell/$NFT - buy the NFT as a brokered transaction
+Both shop endpoints are paged (?after=$ID&limit=$N) and take optional
+token_issuer, min_price & max_price (XRP) and max_fee (percent) filters.
+
+GET /buy/$NFT - buy the NFT as a brokered transaction, settled in the
+background (see flask_nft_xumm.settlement) while the page polls
+GET /buy/status/$PAYLOAD
 
 GET /sell/$NFT - put the NFT up for sale
 """
 import json
-import sqlite3
+import math
 from os import environ
 from pathlib import Path
 
 from flask import (
     Blueprint,
     Markup,
+    abort,
     current_app,
     flash,
     jsonify,
@@ -27,24 +33,23 @@ from flask import (
 from flask_login import current_user, login_required
 from requests import HTTPError
 from xrpl.models.requests import AccountNFTs, NFTSellOffers
-from xrpl.models.transactions import (
-    NFTokenAcceptOffer,
-    NFTokenCreateOffer,
-    NFTokenCreateOfferFlag,
-)
-from xrpl.transaction import (
-    safe_sign_and_autofill_transaction,
-    send_reliable_submission,
-)
-from xrpl.utils import drops_to_xrp, hex_to_str, xrp_to_drops
+from xrpl.models.transactions import NFTokenCreateOffer, NFTokenCreateOfferFlag
+from xrpl.utils import XRPRangeException, drops_to_xrp, xrp_to_drops
 from xrplpers.nfts.entities import TokenID
-from xrplpers.xumm.transactions import get_xumm_transaction, submit_xumm_transaction
+from xrplpers.xumm.transactions import submit_xumm_transaction
 
+from flask_nft_xumm import db
+from flask_nft_xumm.ledger import MAX_IN_FLIGHT
+from flask_nft_xumm.mirror import sell_offers_for
+from flask_nft_xumm.reconcile import import_ledger_offers, offer_from_row
 from flask_nft_xumm.utils import (
+    app_logger,
     cache_offer_to_db,
+    decode_uri,
     get_nft_list_for_account,
-    offer_id_from_transaction_hash,
+    invalidate_account,
 )
+from flask_nft_xumm.webhook import payload_response, track_payload
 
 from blinker import Namespace
 
@@ -52,8 +57,12 @@ trade = Blueprint("trade", __name__, template_folder="templates")
 environ["XUMM_CREDS_PATH"] = "xumm_creds.json"
 
 
+SHOP_PAGE_SIZE = 20
+SHOP_MAX_PAGE_SIZE = 100
+
 trade_signals = Namespace()
 sale_created = trade_signals.signal("sale_created")
+sale_completed = trade_signals.signal("sale_completed")
 
 
 @trade.route("/shop/<issuer>")
@@ -62,45 +71,103 @@ sale_created = trade_signals.signal("sale_created")
 def shop(issuer=None):
     info = None
     nfts = []
-    con = sqlite3.connect("xumm.db")
-    cur = con.cursor()
-    sql = "select token_id, sale_offer, seller from stock where signed = 1"
-    if issuer:
-        sql += f" and seller='{issuer}'"
+    filters = _shop_filters()
+    limit = min(
+        request.args.get("limit", SHOP_PAGE_SIZE, type=int),
+        current_app.config.get("SHOP_MAX_PAGE_SIZE", SHOP_MAX_PAGE_SIZE),
+    )
+    rows, next_after = db.stock_page(
+        after=request.args.get("after", 0, type=int),
+        limit=max(1, limit),
+        seller=issuer,
+        **filters,
+    )
+    reconciler = current_app.stock_reconciler
+    trusted = [bool(reconciler and reconciler.trusts(row)) for row in rows]
+    # Only ask about listings the reconciler hasn't vouched for recently
+    unchecked = [row for row, ok in zip(rows, trusted) if not ok]
     current_app.xrpl_client.open()
-    for row in cur.execute(sql):
-        t = TokenID.from_hex(row[0])
+    lookups = iter(
+        sell_offers_for(
+            [row.token_id for row in unchecked],
+            current_app.xrpl_client,
+            owners=[row.seller for row in unchecked],
+            max_in_flight=current_app.config.get("LEDGER_MAX_IN_FLIGHT", MAX_IN_FLIGHT),
+        )
+    )
+    for row, ok in zip(rows, trusted):
         # TODO: narrow the search over NFTokenPage
         # https://xrpl.org/nftokenpage.html
         # TODO: Cross reference against all sell offers for a token
         # https://xrpl-py.readthedocs.io/en/stable/source/xrpl.models.requests.html?highlight=NFToken#xrpl.models.requests.NFTSellOffers.tokenid
-
-        offers = current_app.xrpl_client.request(
-            NFTSellOffers(nft_id=t.to_str())
-        ).result
-        result = get_nft_list_for_account(row[2])
-        for n in offers.get("offers", []):
-            details = [x for x in result if x["NFTokenID"] == t.to_str()]
-            if len(details):
-                detail = details[0]
-                if n["owner"] == row[2]:
-                    nfts.append(
-                        current_app.nft_factory(
-                            issuer=t.issuer_as_string,
-                            id=t.to_str(),
-                            fee=t.transfer_fee,
-                            uri=hex_to_str(detail["URI"]),
-                            serial=detail["nft_serial"],
-                            owner=row[2],
-                            offer=n,
-                        )
+        if ok:
+            offers = [offer_from_row(row)]
+        else:
+            lookup = next(lookups)
+            if lookup.error:
+                app_logger.getChild("shop").warning(
+                    f"Skipping {lookup.nft_id}: {lookup.error}"
+                )
+                continue
+            offers = lookup.offers
+        uri = row.uri
+        if uri is None:
+            # Listed before URIs were stored, look it up once and keep it
+            details = [
+                x
+                for x in get_nft_list_for_account(row.seller)
+                if x["NFTokenID"] == row.token_id
+            ]
+            if not details:
+                continue
+            uri = decode_uri(details[0].get("URI")) or ""
+            db.stock_set_uri(row.token_id, uri)
+        for n in offers:
+            if n["owner"] == row.seller:
+                nfts.append(
+                    current_app.nft_factory(
+                        issuer=row.issuer,
+                        id=row.token_id,
+                        fee=row.transfer_fee,
+                        uri=uri,
+                        serial=row.serial,
+                        owner=row.seller,
+                        offer=n,
                     )
-    con.close()
+                )
+    next_page = None
+    if next_after is not None:
+        # Keep the filters, but not an `issuer` (or page) from the query string
+        args = dict(request.args.items(), issuer=issuer, after=next_after, limit=limit)
+        next_page = url_for("trade.shop", **args)
     return render_template(
-        "shop.html", info=info, nfts=nfts, drops_to_xrp=drops_to_xrp, issuer=issuer
+        "shop.html",
+        info=info,
+        nfts=nfts,
+        drops_to_xrp=drops_to_xrp,
+        issuer=issuer,
+        next_page=next_page,
     )
 
 
+def _shop_filters():
+    """Turn the shop's query string filters into `db.stock_page` arguments,
+    ignoring any that aren't numbers XRP amounts or fees can be."""
+    args = request.args
+    filters = {"issuer": args.get("token_issuer") or None}
+    for name in ("min_price", "max_price"):
+        value = args.get(name, type=float)
+        try:
+            filters[name] = None if value is None else int(xrp_to_drops(value))
+        except XRPRangeException:
+            filters[name] = None
+    max_fee = args.get("max_fee", type=float)
+    if max_fee is not None and not math.isfinite(max_fee):
+        max_fee = None
+    filters["max_fee"] = None if max_fee is None else int(max_fee * 1000)
+    return filters
+
+
 def calculate_broker_fee(amount):
     """
     Takes a numeric amount and returns the 10% or 1XRP broker fee
@@ -120,48 +187,18 @@ def make_buy_offer(the_wallet, offers):
         "nftoken_id": offers["nft_id"],
     }
     buy = NFTokenCreateOffer.from_dict(purchase)
-    return submit_xumm_transaction(buy.to_xrpl(), user_token=current_user.user_token)
-
-
-def accept_brokered_offer(offers, payload):
-    xumm_data = {"buy": get_xumm_transaction(payload), "sell": offers["offers"][-1]}
-    print(xumm_data)
-    nft = xumm_data["buy"]["payload"]["request_json"]["NFTokenID"]
-    ammount = int(xumm_data["sell"]["amount"])
-    broker_fee = calculate_broker_fee(ammount)
-    current_app.xrpl_client.open()
-    purchase = {
-        "account": current_app.creds["address"],
-        "nftoken_broker_fee": broker_fee,
-        "nftoken_buy_offer": offer_id_from_transaction_hash(
-            xumm_data["buy"]["response"]["txid"], current_app.xrpl_client
-        ),
-    }
-
-    sells = current_app.xrpl_client.request(NFTSellOffers(nft_id=nft)).result["offers"]
-
-    print("ammount is", ammount)
-    print("purchase is", purchase)
-    assert (
-        len(
-            [
-                o
-                for o in sells
-                if o["nft_offer_index"] == xumm_data["sell"]["nft_offer_index"]
-            ]
-        )
-        >= 1
+    xumm_data = submit_xumm_transaction(
+        buy.to_xrpl(), user_token=current_user.user_token
     )
-    purchase["nftoken_sell_offer"] = sells[0]["nft_offer_index"]
-
-    accept = NFTokenAcceptOffer.from_dict(purchase)
-    accept.validate()
-
-    purchase = safe_sign_and_autofill_transaction(
-        accept, current_app.marketplace_wallet, current_app.xrpl_client
+    track_payload(
+        xumm_data,
+        "buy",
+        the_wallet,
+        nft=offers["nft_id"],
+        offer=the_offer,
+        request_json=buy.to_xrpl(),
     )
-    purchase_txn = send_reliable_submission(purchase, current_app.xrpl_client)
-    return purchase_txn
+    return xumm_data
 
 
 @trade.route("/buy", methods=["POST", "GET"])
@@ -171,8 +208,24 @@ def buy(nft=None):
     # TODO: Check the buyer != seller
     if not nft:
         return redirect(url_for("trade.shop"))
+    confirmation = request.args.get("confirm", None)
+    if confirmation:
+        job = db.settlement_get(confirmation)
+        if job:
+            return _settlement_page(job)
+        # Conclude sale in broker mode: the buyer has signed their offer, the
+        # settlement queue brings it and the sell offer it was made against
+        # together
+        job = current_app.settlement_queue.enqueue(
+            confirmation,
+            nft,
+            current_user.wallet.address,
+            _signed_buy_offer(confirmation, nft),
+        )
+        return _settlement_page(job)
     current_app.xrpl_client.open()
-    offers = current_app.xrpl_client.request(NFTSellOffers(nft_id=nft)).result
+    lookup = sell_offers_for([nft], current_app.xrpl_client)[0]
+    offers = {"nft_id": nft, "offers": lookup.offers}
 
     if not offers.get("offers", False):
         flash("No sell offers available")
@@ -187,20 +240,6 @@ def buy(nft=None):
         flash(f"You already own this NFT - {offers['nft_id']}")
         return redirect(url_for("trade.shop"))
 
-    confirmation = request.args.get("confirm", None)
-    if confirmation:
-        # Conclude sale in broker mode
-        # Create the purchase offer then bring the two together as a broker
-        # Need to show the transaction or something here
-        sale_txn_data = accept_brokered_offer(offers, confirmation)
-        return render_template(
-            "buy.html",
-            offer=offers["offers"][-1],
-            nft=nft,
-            drops_to_xrp=drops_to_xrp,
-            confirmation=True,
-            sale=sale_txn_data,
-        )
     # First QR code to sign the buy offer at the price + the broker fee
     xumm_data = make_buy_offer(the_wallet, offers)
     if offers["offers"][-1]["owner"] == the_wallet:
@@ -209,33 +248,112 @@ def buy(nft=None):
         "buy.html",
         qr=xumm_data["refs"]["qr_png"],
         url=xumm_data["next"]["always"],
-        ws=xumm_data["refs"]["websocket_status"],
+        payload=xumm_data["uuid"],
         offer=offers["offers"][-1],
         nft=nft,
         drops_to_xrp=drops_to_xrp,
     )
 
 
+@trade.route("/buy/status/<payload>")
+@login_required
+def buy_status(payload):
+    job = _check_buyer(db.settlement_get(payload))
+    return jsonify(
+        {
+            "state": job.state,
+            "finished": job.state in db.SETTLEMENT_FINISHED,
+            "attempts": job.attempts,
+            "error": job.error,
+            "hash": job.tx_hash,
+        }
+    )
+
+
+def _signed_buy_offer(uuid, nft):
+    """The sell offer (as NFTSellOffers returned it) that the buy offer in
+    payload `uuid` was made against. Only a signed offer for this NFT, from
+    the buyer's own account, can confirm a purchase."""
+    tracked = db.payload_get(uuid)
+    if tracked is None or tracked.kind != "buy" or tracked.context.get("nft") != nft:
+        abort(403)
+    signed = payload_response(uuid)
+    request_json = signed["payload"].get("request_json") or {}
+    if (
+        not signed["meta"].get("signed")
+        or signed["response"].get("account") != current_user.wallet.address
+        or request_json.get("NFTokenID") != nft
+    ):
+        abort(403)
+    return tracked.context["offer"]
+
+
+def _check_buyer(job):
+    # Only the buyer gets to see how their purchase is going
+    if job is None or job.buyer != current_user.wallet.address:
+        abort(404)
+    return job
+
+
+def _settlement_page(job):
+    _check_buyer(job)
+    finished = job.state in db.SETTLEMENT_FINISHED
+    return render_template(
+        "buy.html",
+        nft=job.nft_id,
+        offer={"owner": job.seller, "amount": job.amount},
+        drops_to_xrp=drops_to_xrp,
+        confirmation=finished,
+        pending=not finished,
+        status_url=url_for("trade.buy_status", payload=job.payload_uuid),
+        sale={"result": job.result},
+        error=job.error,
+    )
+
+
 def _flash_nft_sell_exists(nft, offers):
-    # TODO: update the stock DB with these offers
     offers = [x.get("index") for x in offers["offers"] if x.get("index")]
     flash(Markup(render_template("_nft_sale_exists.html", nft=nft, offers=offers)))
 
 
-def sqlite_stock_update(*args, **kwargs):
-    con = sqlite3.connect("xumm.db")
-    cur = con.cursor()
-    data = kwargs["payload"]
-    sell_offer = get_xumm_transaction(data["payload_uuidv4"])
-    txn = sell_offer["response"]["txid"]
-    offer_id = offer_id_from_transaction_hash(txn, current_app.xrpl_client)
-
-    cur.execute(
-        "update stock set signed = 1, sale_offer = ? where sale_offer = ?",
-        [offer_id, json.loads(request.json)["payload_uuidv4"]],
-    )
-    con.commit()
-    con.close()
+def sqlite_stock_update(sender, payload, accounts=(), txid=None, **kwargs):
+    """Mark the listing signed once its offer is validated. The listing stays
+    pending until then; the wait is left to `sender.validation_watcher` so
+    the request or webhook that signalled the sale doesn't hold a thread."""
+    uuid = payload["payload_uuidv4"]
+    txn = txid or payload_response(uuid)["response"]["txid"]
+
+    def validated(entry):
+        if not entry["offers"]:
+            app_logger.getChild("sale").warning(f"{txn} created no offer for {uuid}")
+            return
+        db.stock_mark_signed(uuid, entry["offers"][0]["nft_offer_index"])
+        # The seller's wallet won't be cached without the offer now
+        for account in accounts:
+            invalidate_account(account)
+
+    sender.validation_watcher.watch(txn, validated)
+
+
+def on_payload_resolved(sender, payload):
+    """Carry on with a sale or purchase once the seller or buyer has signed
+    its XUMM payload, see flask_nft_xumm.webhook."""
+    if not payload.signed:
+        return
+    if payload.kind == "sell":
+        sale_created.send(
+            sender,
+            payload={"payload_uuidv4": payload.uuid},
+            accounts=[payload.account],
+            txid=payload.txid,
+        )
+    elif payload.kind == "buy":
+        sender.settlement_queue.enqueue(
+            payload.uuid,
+            payload.context["nft"],
+            payload.account,
+            payload.context["offer"],
+        )
 
 
 @trade.route("/sell", methods=["POST", "GET"])
@@ -247,16 +365,18 @@ def sell(nft=None):
     the transaction id to the database.
     """
     current_app.xrpl_client.open()
-    if request.method == "POST" and nft:
-        # Store the Sell offer transaction id
-        sale_created.send(current_app._get_current_object(), payload=request.get_json())
-        return jsonify({"ok": True})
-    elif request.method == "POST":
+    # The signed offer is stored when its payload resolves (see
+    # on_payload_resolved), not from anything the browser posts back
+    if request.method == "POST":
         # Create the sale offer, and have XUMM generate the QR to let the seller sign it
         offers = current_app.xrpl_client.request(
             NFTSellOffers(nft_id=request.form["tokenid"])
         ).result
         if len(offers.get("offers", [])) > 0:
+            # List what's already on sale, rather than offering it twice
+            import_ledger_offers(
+                request.form["tokenid"], offers["offers"], current_app.xrpl_client
+            )
             _flash_nft_sell_exists(request.form["tokenid"], offers)
 
             return render_template(
@@ -276,8 +396,17 @@ def sell(nft=None):
         xumm_data = submit_xumm_transaction(
             sell.to_xrpl(), user_token=current_user.user_token
         )
-
-        cache_offer_to_db(token.to_str(), xumm_data["uuid"], 0, the_wallet)
+        track_payload(xumm_data, "sell", the_wallet, nft=token.to_str())
+
+        held = current_user.wallet.nft(token.to_str()) or {}
+        cache_offer_to_db(
+            token.to_str(),
+            xumm_data["uuid"],
+            0,
+            the_wallet,
+            price=price,
+            uri=decode_uri(held.get("URI")),
+        )
 
         qr = xumm_data["refs"]["qr_png"]
         url = xumm_data["next"]["always"]
@@ -285,7 +414,7 @@ def sell(nft=None):
             "sell.html",
             qr=qr,
             url=url,
-            ws=xumm_data["refs"]["websocket_status"],
+            payload=xumm_data["uuid"],
             token=token.to_str(),
             price=drops_to_xrp(price),
         )
@@ -298,7 +427,6 @@ def sell(nft=None):
         offers = current_app.xrpl_client.request(NFTSellOffers(nft_id=nft)).result
         cant_sell = False
         if len(offers.get("offers", [])) > 0:
-            # TODO: add the sale offer to the DB if not in it already
             _flash_nft_sell_exists(nft, offers)
             cant_sell = True
         return render_template("sell.html", nft=nft, cant_sell=cant_sell)
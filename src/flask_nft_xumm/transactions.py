@@ -0,0 +1,249 @@
+"""
+Validated transactions, looked up once and remembered.
+
+A validated transaction never changes, so once one has been fetched (or seen
+on the ledger mirror's stream, or submitted by the marketplace signer) it's
+kept in `tx_cache`, along with the NFTokenOffers it created. Asking about the
+same hash again, from any worker, costs nothing. (The mirror only passes on
+transactions the app is waiting for, see `awaited`.)
+
+`validated_transaction` waits for a transaction that isn't validated yet,
+checking the cache (which the mirror fills as ledgers close) and asking the
+ledger with a backoff of up to one ledger close. Concurrent waits for the
+same hash share one loop.
+
+Where nothing needs the outcome there and then, `ValidationWatcher.watch`
+hands the wait to a background thread in each worker, which calls back once
+the transaction is validated, so requests and webhooks don't wait for the
+ledger.
+"""
+import os
+import threading
+import time
+
+from xrpl.models.requests import Tx
+
+from flask_nft_xumm import db
+from flask_nft_xumm.cache import SingleFlight
+from flask_nft_xumm.shared_cache import SharedCache
+
+# How long (in seconds) to wait for a transaction to be validated
+WAIT_TIMEOUT = 10
+# First pause between lookups, doubling up to LEDGER_CLOSE
+FIRST_POLL = 0.5
+LEDGER_CLOSE = 4
+# How long (in seconds) `ValidationWatcher` keeps looking for a transaction,
+# well past any last ledger sequence the app signs with
+WATCH_TIMEOUT = 300
+
+tx_cache = SharedCache("tx", ttl=24 * 60 * 60, maxsize=512)
+
+_flight = SingleFlight()
+_waiting = {}
+_waiting_lock = threading.Lock()
+# Hashes a ValidationWatcher in this process is looking out for
+_watching = set()
+
+
+class TransactionNotValidated(Exception):
+    pass
+
+
+class TransactionLookupFailed(Exception):
+    """The ledger couldn't say whether a transaction was validated (as
+    opposed to `txnNotFound`, which means it hasn't been)."""
+
+
+def created_offers(meta):
+    """The NFTokenOffers a transaction created, from its metadata."""
+    offers = []
+    for node in meta.get("AffectedNodes", []):
+        created = node.get("CreatedNode", {})
+        if created.get("LedgerEntryType") != "NFTokenOffer":
+            continue
+        fields = created["NewFields"]
+        offers.append(
+            {
+                "nft_offer_index": created["LedgerIndex"],
+                "nft_id": fields["NFTokenID"],
+                "owner": fields["Owner"],
+                "amount": fields["Amount"],
+                "flags": int(fields.get("Flags", 0)),
+            }
+        )
+    return offers
+
+
+def remember(result):
+    """Cache a validated transaction, as the `tx` method returns it, and wake
+    anyone in this process waiting for it."""
+    entry = {"tx": result, "offers": created_offers(result.get("meta", {}))}
+    tx_cache.set(result["hash"], entry)
+    with _waiting_lock:
+        event = _waiting.pop(result["hash"], None)
+    if event is not None:
+        event.set()
+    return entry
+
+
+def awaited(tx_hash):
+    """Whether anyone is likely to ask about `tx_hash`: a thread in this
+    process is waiting for it, or it belongs to a payload or settlement the
+    app is tracking."""
+    with _waiting_lock:
+        if tx_hash in _waiting or tx_hash in _watching:
+            return True
+    return db.transaction_tracked(tx_hash)
+
+
+def remember_stream_message(message):
+    """Cache the validated transaction in a transaction stream message, if
+    it's one the app is waiting for (see `awaited`); the stream carries every
+    transaction of the watched accounts, most of which nobody asks about."""
+    if message.get("type") != "transaction" or not message.get("validated"):
+        return
+    if awaited(message["transaction"]["hash"]):
+        remember(
+            dict(
+                message["transaction"],
+                meta=message["meta"],
+                validated=True,
+                ledger_index=message.get("ledger_index"),
+            )
+        )
+
+
+def find_transaction(tx_hash, client):
+    """The cached entry (`{"tx": ..., "offers": [...]}`) for `tx_hash` if it's
+    been validated, otherwise None. Asks the ledger at most once, raising
+    `TransactionLookupFailed` if it answers with anything but the transaction
+    or `txnNotFound`."""
+    entry = tx_cache.get(tx_hash)
+    if entry is not None:
+        return entry
+    response = client.request(Tx(transaction=tx_hash))
+    if not response.is_successful():
+        if response.result.get("error") == "txnNotFound":
+            return None
+        raise TransactionLookupFailed(f"{tx_hash}: {response.result}")
+    if response.result.get("validated"):
+        return remember(response.result)
+    return None
+
+
+def _wait(tx_hash, client, timeout):
+    deadline = time.monotonic() + timeout
+    delay = FIRST_POLL
+    with _waiting_lock:
+        event = _waiting.setdefault(tx_hash, threading.Event())
+    try:
+        while True:
+            entry = find_transaction(tx_hash, client)
+            if entry is not None:
+                return entry
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TransactionNotValidated(f"{tx_hash} not validated in {timeout}s")
+            event.wait(min(delay, remaining))
+            delay = min(delay * 2, LEDGER_CLOSE)
+    finally:
+        with _waiting_lock:
+            if _waiting.get(tx_hash) is event:
+                del _waiting[tx_hash]
+
+
+def validated_transaction(tx_hash, client, timeout=WAIT_TIMEOUT):
+    """The cached entry for `tx_hash`, waiting up to `timeout` seconds for it
+    to be validated. Raises `TransactionNotValidated` if it isn't."""
+    entry = tx_cache.get(tx_hash)
+    if entry is not None:
+        return entry
+    return _flight.do(tx_hash, _wait, tx_hash, client, timeout)
+
+
+def created_offer_id(tx_hash, client, timeout=WAIT_TIMEOUT):
+    """The id of the NFTokenOffer transaction `tx_hash` created, or None."""
+    offers = validated_transaction(tx_hash, client, timeout)["offers"]
+    return offers[0]["nft_offer_index"] if offers else None
+
+
+class ValidationWatcher:
+    def __init__(self, app, interval=LEDGER_CLOSE, timeout=WATCH_TIMEOUT):
+        self.app = app
+        self.interval = interval
+        self.timeout = timeout
+        # tx hash -> (deadline, [callbacks])
+        self.pending = {}
+        self.validated = self.expired = self.failed = 0
+        self.wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def watch(self, tx_hash, callback):
+        """Call `callback(entry)`, with the cached entry for `tx_hash`, in an
+        app context once it's been validated."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads don't survive a fork
+                self.pending = {}
+                self._pid = os.getpid()
+                threading.Thread(
+                    target=self.run, name="validation", daemon=True
+                ).start()
+            deadline = time.monotonic() + self.timeout
+            self.pending.setdefault(tx_hash, (deadline, []))[1].append(callback)
+        with _waiting_lock:
+            _watching.add(tx_hash)
+        self.wake.set()
+
+    def run_once(self):
+        """Check each pending transaction once, calling back for those that
+        have been validated."""
+        logger = self.app.logger.getChild("validation")
+        with self._lock:
+            pending = list(self.pending.items())
+        for tx_hash, (deadline, callbacks) in pending:
+            with self.app.app_context():
+                try:
+                    entry = find_transaction(tx_hash, self.app.xrpl_client)
+                except Exception:
+                    logger.exception(f"Looking up {tx_hash} failed")
+                    entry = None
+                if entry is None:
+                    if time.monotonic() > deadline:
+                        logger.warning(f"{tx_hash} wasn't validated, giving up")
+                        self.expired += 1
+                        self._forget(tx_hash)
+                    continue
+                if not self._forget(tx_hash):
+                    # Another thread got there first
+                    continue
+                self.validated += 1
+                for callback in callbacks:
+                    try:
+                        callback(entry)
+                    except Exception:
+                        self.failed += 1
+                        logger.exception(f"Handling {tx_hash} failed")
+        return len(pending)
+
+    def _forget(self, tx_hash):
+        with self._lock:
+            found = self.pending.pop(tx_hash, None) is not None
+        with _waiting_lock:
+            _watching.discard(tx_hash)
+        return found
+
+    def run(self):
+        while True:
+            self.run_once()
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "validated": self.validated,
+            "expired": self.expired,
+            "failed": self.failed,
+        }
@@ -1,23 +1,20 @@
-import sqlite3
-import sys
+import threading
 from os import environ
 from urllib.parse import urljoin, urlparse
 
-import requests
-
-py_version = sys.version_info
-if py_version.major == 3 and py_version.minor >= 9:
-    from functools import cache
-else:
-    from functools import lru_cache as cache
-
 from flask import current_app, request
 from xrpl.account import get_account_info
+from xrpl.clients import XRPLRequestFailureException
 from xrpl.models.requests import AccountNFTs
-from xrpl.transaction import get_transaction_from_hash
-from xrpl.utils import drops_to_xrp, hex_to_str, str_to_hex
+from xrpl.utils import drops_to_xrp, hex_to_str
+from xrplpers.nfts.entities import TokenID
+from xrplpers.xumm.transactions import get_xumm_transaction
 
-from flask_nft_xumm.decorators import time_cache
+from flask_nft_xumm import db
+from flask_nft_xumm.bithomp import FIELDS, bithomp_cache
+from flask_nft_xumm.decorators import access_decisions, coalesce
+from flask_nft_xumm.ledger import nft_serial_and_taxon
+from flask_nft_xumm.shared_cache import SharedCache
 from werkzeug.local import LocalProxy
 
 environ["XUMM_CREDS_PATH"] = "xumm_creds.json"
@@ -25,51 +22,116 @@ environ["XUMM_CREDS_PATH"] = "xumm_creds.json"
 app_logger = LocalProxy(lambda: current_app.logger)
 
 
-@time_cache(300)
-def get_bithomp(nft_id):
-    logger = app_logger.getChild("bithomp")
-    fields = {x: "true" for x in "sellOffers buyOffers uri history".split()}
-    bithomp = requests.get(
-        f"{current_app.creds['bithomp_url']}/api/v2/nft/{nft_id}",
-        headers={"x-bithomp-token": current_app.creds["bithomp"]},
-        params=fields,
+def _encode_wallet_data(value):
+    return value.state() if isinstance(value, WalletIndex) else value
+
+
+def _decode_wallet_data(value):
+    return WalletIndex.from_state(value) if "nfts" in value else value
+
+
+# Wallet NFTs & account info, keyed on (kind, address) and shared by every
+# XUMMWalletProxy in every worker, see `shared_cache`.
+wallet_data_cache = SharedCache(
+    "wallet",
+    ttl=300,
+    tags=lambda key: (key[1],),
+    encode=_encode_wallet_data,
+    decode=_decode_wallet_data,
+)
+# The NFTs held by each seller we've listed stock for.
+nft_list_cache = SharedCache(
+    "nft_list", ttl=900, maxsize=256, tags=lambda account: (account,)
+)
+
+# The most AccountNFTs will return in one page
+NFT_PAGE_SIZE = 400
+
+
+def get_bithomp(nft_id, fields=FIELDS):
+    return current_app.bithomp.nft(nft_id, fields)
+
+
+# Fetching the same XUMM payload from several requests at once (e.g. a browser
+# retrying its POST) only asks XUMM once
+get_xumm_payload = coalesce(get_xumm_transaction)
+
+
+def get_nft_list_for_account(account, force=False):
+    return nft_list_cache.get_or_set(
+        account, lambda: XUMMWalletProxy(account).nfts, force=force
     )
 
-    bithomp.raise_for_status()
-    data = bithomp.json()
-    logger.debug(data)
-    data["uri_hex"] = data["uri"]
-    data["uri"] = hex_to_str(data["uri"])
-    return data
-
-
-@cache
-def get_nft_list_for_account(account):
-    p = XUMMWalletProxy(account)
-    return p.nfts
-
-
-def offer_id_from_transaction_hash(txn_hash, client):
-    print("searching for", txn_hash)
-    txn = get_transaction_from_hash(txn_hash, client)
-    print(txn)
-    for node in txn.result["meta"]["AffectedNodes"]:
-        for node_type in ["CreatedNode", "ModifiedNode"]:
-            if node_type in node:
-                if node[node_type]["LedgerEntryType"] == "NFTokenOffer":
-                    print("found", node[node_type]["LedgerIndex"], "for", txn_hash)
-                    return node[node_type]["LedgerIndex"]
-
-
-def cache_offer_to_db(token_id, sale_offer, signed, seller):
-    con = sqlite3.connect("xumm.db")
-    cur = con.cursor()
-    cur.execute(
-        "insert into stock values (?, ?, ?, ?)",
-        (token_id, sale_offer, signed, seller),
+
+def invalidate_account(account):
+    """Forget everything cached about `account`, e.g. after it buys, sells or
+    mints an NFT."""
+    nft_list_cache.invalidate_tag(account)
+    wallet_data_cache.invalidate_tag(account)
+    access_decisions.invalidate_where(lambda key: key[0] == account)
+
+
+def invalidate_signal_accounts(sender, accounts=(), txid=None, **kwargs):
+    """Signal receiver that forgets what's cached about each of `accounts`,
+    connect it to any signal sent when a transaction changes a wallet.
+
+    A signal sent when the transaction is signed, rather than validated,
+    should name it as `txid`: a page loaded in between caches the wallet as
+    it was, so the accounts are forgotten again once it's validated (see
+    `transactions.ValidationWatcher`)."""
+    accounts = set(accounts)
+    for account in accounts:
+        invalidate_account(account)
+    watcher = getattr(sender, "validation_watcher", None)
+    if txid and watcher is not None:
+
+        def validated(entry):
+            for account in accounts:
+                invalidate_account(account)
+
+        watcher.watch(txid, validated)
+
+
+def cache_stats():
+    return {
+        name: dict(c.stats(), bytes=c.memory_usage())
+        for name, c in [
+            ("wallet_data", wallet_data_cache),
+            ("nft_list", nft_list_cache),
+            ("bithomp", bithomp_cache),
+            ("access_decisions", access_decisions),
+        ]
+    }
+
+
+def cache_offer_to_db(
+    token_id, sale_offer, signed, seller, price=None, checked_at=None, uri=None
+):
+    """Store a listing along with the token's metadata, so the shop can show
+    it without parsing the id or fetching the seller's NFTs."""
+    token = TokenID.from_hex(token_id)
+    serial, _ = nft_serial_and_taxon(token.to_str())
+    db.stock_insert(
+        token.to_str(),
+        sale_offer,
+        signed,
+        seller,
+        issuer=token.issuer_as_string,
+        transfer_fee=token.transfer_fee.value,
+        price=None if price is None else int(price),
+        checked_at=checked_at,
+        serial=serial,
+        uri=uri,
     )
-    con.commit()
-    con.close()
+
+
+def decode_uri(hexed):
+    """The string form of a hex URI, or None if there isn't a valid one."""
+    try:
+        return hex_to_str(hexed) if hexed else None
+    except ValueError:
+        # Not every URI is valid UTF-8
+        return None
 
 
 def is_safe_url(target):
@@ -78,6 +140,76 @@ def is_safe_url(target):
     return test_url.scheme in ("http", "https") and ref_url.netloc == test_url.netloc
 
 
+class WalletIndex:
+    """A snapshot of the NFTs in a wallet, indexed for ownership checks.
+
+    Built once per fetch of the wallet and cached with it, so `has_nft` is a
+    set/dict lookup rather than a scan of the wallet. Pages of `AccountNFTs`
+    are added with `add_page` as they arrive; until the last page is in,
+    `complete` is False and `marker` is where to resume from.
+    """
+
+    __slots__ = (
+        "nfts",
+        "ids",
+        "by_id",
+        "by_hex_uri",
+        "by_uri",
+        "marker",
+        "complete",
+        "lock",
+    )
+
+    def __init__(self, nfts=()):
+        self.nfts = []
+        self.ids = frozenset()
+        self.by_id = {}
+        self.by_hex_uri = {}
+        self.by_uri = {}
+        self.marker = None
+        self.complete = False
+        self.lock = threading.Lock()
+        if nfts:
+            self.add_page(nfts)
+
+    def __len__(self):
+        return len(self.nfts)
+
+    def state(self):
+        """What's needed to rebuild the index, as plain JSON."""
+        return {"nfts": self.nfts, "marker": self.marker, "complete": self.complete}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls()
+        if state["complete"] or state["marker"]:
+            index.add_page(state["nfts"], state["marker"])
+        return index
+
+    def add_page(self, nfts, marker=None):
+        nfts = list(nfts)
+        for nft in nfts:
+            self.by_id[nft["NFTokenID"]] = nft
+            hexed = nft.get("URI")
+            if not hexed:
+                continue
+            self.by_hex_uri.setdefault(hexed.upper(), nft)
+            uri = decode_uri(hexed)
+            if uri is not None:
+                self.by_uri.setdefault(uri, nft)
+        self.ids = self.ids.union(nft["NFTokenID"] for nft in nfts)
+        self.nfts.extend(nfts)
+        self.marker = marker
+        self.complete = marker is None
+
+    def has_nft(self, uri=None, hexed_uri=None, id=None):
+        if id:
+            return id in self.ids
+        if uri:
+            return uri in self.by_uri
+        return bool(hexed_uri) and hexed_uri.upper() in self.by_hex_uri
+
+
 class XUMMWalletProxy:
     def __init__(self, address):
         self.address = address
@@ -94,47 +226,82 @@ class XUMMWalletProxy:
     def account_data(self):
         return self._get_account_info()["account_data"]
 
-    @time_cache(60)
     def _get_account_info(self, force=False):
-        """Retrieve the users wallet info, caching the result for 60 seconds.
+        """Retrieve the users wallet info, caching the result in
+        `wallet_data_cache`.
 
-        Pass in a random value to force (or a value that hasn't been used in
-        the past 60s) to force a refresh of the cache. Useful after you make a
-        transaction that you know affects the wallets NFTs.
+        Pass `force=True` to refresh the cache. Useful after you make a
+        transaction that you know affects the wallet.
         """
-        with current_app.app_context():
-            current_app.xrpl_client.open()
-            return get_account_info(self.address, current_app.xrpl_client).result
+
+        def fetch():
+            with current_app.app_context():
+                current_app.xrpl_client.open()
+                return get_account_info(self.address, current_app.xrpl_client).result
+
+        return wallet_data_cache.get_or_set(
+            ("account_info", self.address), fetch, force=force
+        )
 
     def has_nft(self, uri=None, hexed_uri=None, id=None):
-        if id:
-            return id in [nft["NFTokenID"] for nft in self.nfts]
-        if uri:
-            hexed_uri = str_to_hex(uri).upper()
-        return hexed_uri in self.nft_uris
+        """Check the wallet for an NFT, only paging through as much of the
+        wallet as it takes to find it."""
+        index = self._get_wallet_nfts(
+            until=lambda i: i.has_nft(uri=uri, hexed_uri=hexed_uri, id=id)
+        )
+        return index.has_nft(uri=uri, hexed_uri=hexed_uri, id=id)
+
+    def nft(self, id):
+        """The wallet's entry for the NFT `id`, or None if it doesn't hold it."""
+        return self._get_wallet_nfts(until=lambda i: id in i.ids).by_id.get(id)
 
     @property
-    def nft_uris(self, as_string=False):
-        if as_string:
-            return [hex_to_str(nft["URI"]) for nft in self.nfts]
-        return [nft["URI"] for nft in self.nfts]
+    def nft_uris(self):
+        return self._get_wallet_nfts().by_hex_uri.keys()
 
     @property
     def nfts(self):
-        data = self._get_wallet_nfts()
-        return [nft for nft in data.result.get("account_nfts", [])]
+        return self._get_wallet_nfts().nfts
 
-    @time_cache(60)
-    def _get_wallet_nfts(self, force=False):
-        """Retrieve the users NFTs from their wallet, caching the result for
-        60 seconds.
+    def nfts_version(self):
+        """Changes whenever the cached NFTs do, in any worker; None while
+        they aren't cached."""
+        return wallet_data_cache.version(("account_nfts", self.address))
 
-        Pass in a random value to force (or a value that hasn't been used in
-        the past 60s) to force a refresh of the cache. Useful after you make a
+    def _get_wallet_nfts(self, force=False, until=None):
+        """Retrieve the users NFTs from their wallet as a `WalletIndex`,
+        caching the result in `wallet_data_cache`.
+
+        Follows the `AccountNFTs` marker until the whole wallet is loaded, or
+        until `until(index)` is true, in which case the partial index is
+        cached and later calls (in any worker) carry on from where it stopped.
+
+        Pass `force=True` to refresh the cache. Useful after you make a
         transaction that you know affects the wallets NFTs.
         """
+        index = wallet_data_cache.get_or_set(
+            ("account_nfts", self.address), WalletIndex, force=force
+        )
+        with index.lock:
+            fetched = False
+            while not index.complete and not (until and until(index)):
+                page = self._get_wallet_nfts_page(index.marker)
+                index.add_page(page.get("account_nfts", []), page.get("marker"))
+                fetched = True
+            if fetched:
+                wallet_data_cache.set(("account_nfts", self.address), index)
+        return index
+
+    def _get_wallet_nfts_page(self, marker=None):
+        """One page of AccountNFTs. Raises `XRPLRequestFailureException` for
+        an error (e.g. actNotFound, or being rate limited) rather than
+        returning it, which would read as an empty, complete wallet and be
+        cached as one."""
         with current_app.app_context():
             current_app.xrpl_client.open()
-            return current_app.xrpl_client.request(
-                AccountNFTs(account=self.address, limit=150)
+            response = current_app.xrpl_client.request(
+                AccountNFTs(account=self.address, limit=NFT_PAGE_SIZE, marker=marker)
             )
+        if not response.is_successful() or "error" in response.result:
+            raise XRPLRequestFailureException(response.result)
+        return response.result
@@ -3,7 +3,7 @@ Implements one endpoint:
 
 GET /wallet - lists all NFTs owned by the logged in user
 """
-import sqlite3
+import json
 from collections import defaultdict
 from http import client
 
@@ -16,7 +16,10 @@ from xrpl.utils import hex_to_str, str_to_hex
 from xrplpers.nfts.entities import TokenID, TransferFee
 from xrplpers.xumm.transactions import submit_xumm_transaction
 
+from flask_nft_xumm import db
+from flask_nft_xumm.mirror import listed_offers
 from flask_nft_xumm.utils import get_bithomp, get_nft_list_for_account, app_logger
+from flask_nft_xumm.webhook import payload_response
 
 from blinker import Namespace
 
@@ -25,6 +28,7 @@ wallet = Blueprint("wallet", __name__, template_folder="templates")
 wallet_signals = Namespace()
 mint_request = wallet_signals.signal("mint_request")
 mint_signed = wallet_signals.signal("mint_signed")
+offer_cancelled = wallet_signals.signal("offer_cancelled")
 
 
 @wallet.route("/wallet")
@@ -32,14 +36,24 @@ mint_signed = wallet_signals.signal("mint_signed")
 def index():
     logger = app_logger.getChild("wallet.index")
     offer_lookup = defaultdict(list)
-    con = sqlite3.connect("xumm.db")
-    cur = con.cursor()
-    sql = "select token_id, sale_offer from stock where seller = ? and signed=1"
-    for row in cur.execute(sql, [current_user.wallet.address]):
-        logger.debug(row)
-        offer_lookup[row[0]].append(row[1])
+    mirror = current_app.ledger_mirror
+    if mirror and mirror.watching(current_user.wallet.address):
+        for token_id, offer_id in db.mirror_offers_by_owner(
+            current_user.wallet.address
+        ):
+            offer_lookup[token_id].append(offer_id)
+    else:
+        # Checked against the ledger, if the login prefetch has cached them
+        listed = listed_offers(
+            current_user.wallet.address, current_app.xrpl_client, cached_only=True
+        )
+        if listed is not None:
+            offer_lookup.update(listed)
+        else:
+            for row in db.stock_signed(seller=current_user.wallet.address):
+                logger.debug(row)
+                offer_lookup[row.token_id].append(row.sale_offer)
     logger.debug(offer_lookup)
-    con.close()
 
     nfts = defaultdict(list)
     for n in current_user.wallet.nfts:
@@ -47,12 +61,13 @@ def index():
         # ledger for each NFT. If you need correctness, use the following:
         # offers = client.request(NFTSellOffers(tokenid=n["NFTokenID"])).result
         logger.debug(n)
-        nfts[hex_to_str(n["URI"])].append(
+        uri = hex_to_str(n["URI"])
+        nfts[uri].append(
             current_app.nft_factory(
                 issuer=n["Issuer"],
                 id=n["NFTokenID"],
                 fee=n["TransferFee"],
-                uri=hex_to_str(n["URI"]),
+                uri=uri,
                 serial=n["nft_serial"],
                 owner=current_user.wallet.address,
                 offer=offer_lookup.get(n["NFTokenID"], []),
@@ -61,6 +76,19 @@ def index():
     return render_template("wallet.html", nfts=nfts)
 
 
+def signed_txid(message):
+    """The id of the transaction a XUMM websocket message, as the signing
+    pages post it back, says was signed."""
+    if isinstance(message, str):
+        # cancel.html sends it JSON encoded twice
+        message = json.loads(message)
+    if not message or not message.get("payload_uuidv4"):
+        return None
+    if message.get("txid"):
+        return message["txid"]
+    return payload_response(message["payload_uuidv4"])["response"].get("txid")
+
+
 @wallet.route("/wallet/cancel/<offer>", methods=["GET", "POST"])
 @login_required
 def cancel(offer):
@@ -82,12 +110,13 @@ def cancel(offer):
         )
     else:
         # TODO: verify the XUMM transaction coming in
-        con = sqlite3.connect("xumm.db")
-        cur = con.cursor()
-        sql = "delete from stock where sale_offer=?"
-        cur.execute(sql, [offer])
-        con.commit()
-        con.close()
+        db.stock_delete_offer(offer)
+        offer_cancelled.send(
+            current_app._get_current_object(),
+            offer=offer,
+            accounts=[the_wallet],
+            txid=signed_txid(request.get_json(silent=True)),
+        )
 
         return jsonify({"ok": True})
 
@@ -101,7 +130,12 @@ def mint():
     elif request.json:
         logger.debug("Minting response")
         logger.debug(request.get_json())
-        mint_signed.send(current_app._get_current_object(), payload=request.get_json())
+        mint_signed.send(
+            current_app._get_current_object(),
+            payload=request.get_json(),
+            accounts=[current_user.wallet.address],
+            txid=signed_txid(request.get_json()),
+        )
         return jsonify(
             {"ok": True, "payload_uuidv4": request.get_json()["payload_uuidv4"]}
         )
@@ -0,0 +1,149 @@
+"""
+Implements two endpoints:
+
+POST /xumm/webhook - XUMM's callback when a payload is signed or rejected
+GET /xumm/payload/$UUID - whether a payload has been resolved yet
+
+Every payload the app asks a user to sign is recorded with `track_payload`,
+along with what it's for. Set `https://YOUR.HOST/xumm/webhook` as your XUMM
+application's webhook URL and `"xumm_webhook": true` in `creds.json`; each
+callback is checked against its HMAC signature, the outcome stored and
+`payload_resolved` sent, so the sale and purchase flows carry on without the
+browser reporting back or anyone fetching the payload again.
+
+Pages wait for the signature by polling `/xumm/payload/$UUID`, which only
+reads the database. Without the webhook (or if its callback hasn't arrived
+after `WEBHOOK_GRACE` seconds) that endpoint asks XUMM instead, and stores
+and signals the outcome the same way.
+"""
+import hashlib
+import hmac
+import json
+import time
+from os import environ
+from pathlib import Path
+
+from blinker import Namespace
+from flask import Blueprint, abort, current_app, jsonify, request
+
+from flask_nft_xumm import db
+from flask_nft_xumm.utils import app_logger, get_xumm_payload
+
+webhook = Blueprint("webhook", __name__)
+webhook_signals = Namespace()
+payload_resolved = webhook_signals.signal("payload_resolved")
+
+# Callbacks older (or newer) than this many seconds are refused
+WEBHOOK_MAX_AGE = 300
+# How long to wait for a callback before asking XUMM
+WEBHOOK_GRACE = 30
+
+
+def verify_signature(secret, timestamp, body, signature):
+    """Check a callback's X-Xumm-Request-Signature: the hex HMAC-SHA1 of the
+    timestamp header followed by the body, keyed with the application's API
+    secret less its dashes."""
+    expected = hmac.new(
+        secret.replace("-", "").encode(), timestamp.encode() + body, hashlib.sha1
+    ).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+
+def _api_secret():
+    creds = json.loads(Path(environ["XUMM_CREDS_PATH"]).read_text())
+    return creds["x-api-secret"]
+
+
+def track_payload(xumm_data, kind, account=None, **context):
+    """Record the payload XUMM returned in `xumm_data` as being for `kind`,
+    to be signed by `account`."""
+    db.payload_track(xumm_data["uuid"], kind, account, context)
+
+
+def resolve_payload(uuid, signed, txid=None, account=None, user_token=None):
+    """Store the outcome of a tracked payload and, the first time, send
+    `payload_resolved` with it."""
+    if db.payload_resolve(uuid, signed, txid, account, user_token):
+        try:
+            payload_resolved.send(
+                current_app._get_current_object(), payload=db.payload_get(uuid)
+            )
+        except Exception:
+            # Leave it for the next callback or poll to try again
+            db.payload_unresolve(uuid)
+            raise
+
+
+def payload_response(uuid):
+    """The parts of XUMM's GET payload response the app uses, from the stored
+    outcome if there is one, otherwise from XUMM."""
+    tracked = db.payload_get(uuid)
+    if tracked is None or not tracked.resolved:
+        return get_xumm_payload(uuid)
+    return {
+        "meta": {"resolved": True, "signed": bool(tracked.signed)},
+        "application": {"issued_user_token": tracked.user_token},
+        "payload": {"request_json": tracked.context.get("request_json")},
+        "response": {"txid": tracked.txid, "account": tracked.account},
+    }
+
+
+def _resolve_from_xumm(uuid):
+    xumm_data = get_xumm_payload(uuid)
+    if xumm_data["meta"]["resolved"]:
+        resolve_payload(
+            uuid,
+            xumm_data["meta"]["signed"],
+            xumm_data["response"].get("txid"),
+            xumm_data["response"].get("account"),
+            xumm_data["application"].get("issued_user_token"),
+        )
+
+
+@webhook.route("/xumm/webhook", methods=["POST"])
+def callback():
+    logger = app_logger.getChild("webhook")
+    body = request.get_data()
+    timestamp = request.headers.get("X-Xumm-Request-Timestamp", "")
+    if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > WEBHOOK_MAX_AGE:
+        abort(403)
+    signature = request.headers.get("X-Xumm-Request-Signature")
+    if not verify_signature(_api_secret(), timestamp, body, signature):
+        abort(403)
+
+    data = json.loads(body)
+    response = data.get("payloadResponse") or {}
+    uuid = response.get("payload_uuidv4") or data["meta"]["payload_uuidv4"]
+    tracked = db.payload_get(uuid)
+    logger.debug(f"{uuid}: {response}")
+    if tracked is None:
+        # Not one of ours, or from before payloads were tracked
+        return jsonify({"ok": True})
+    signed = bool(response.get("signed"))
+    account = None
+    if signed:
+        # The callback doesn't say who signed, which a sign in needs, and
+        # which may not be the account the payload was made for
+        account = get_xumm_payload(uuid)["response"]["account"]
+    resolve_payload(
+        uuid,
+        signed,
+        response.get("txid"),
+        account,
+        (data.get("userToken") or {}).get("user_token"),
+    )
+    return jsonify({"ok": True})
+
+
+@webhook.route("/xumm/payload/<uuid>")
+def status(uuid):
+    tracked = db.payload_get(uuid)
+    if tracked is None:
+        abort(404)
+    if not tracked.resolved and (
+        not current_app.creds.get("xumm_webhook")
+        or time.time() - tracked.created_at > WEBHOOK_GRACE
+    ):
+        _resolve_from_xumm(uuid)
+        tracked = db.payload_get(uuid)
+    return jsonify({"resolved": bool(tracked.resolved), "signed": bool(tracked.signed)})
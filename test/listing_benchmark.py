@@ -0,0 +1,93 @@
+"""
+Compares the dicts `app.nft_factory` used to return with `NFTListing`: the
+memory held by a page's worth of listings, and the time to build them and
+render them through the shop's markup.
+
+    python test/listing_benchmark.py
+"""
+import gc
+import random
+import timeit
+import tracemalloc
+
+from jinja2 import Environment
+from xrpl.core.addresscodec import encode_classic_address
+from xrpl.utils import drops_to_xrp
+
+from flask_nft_xumm.listing import NFTListing
+
+LISTINGS = 20_000
+# Listings come from a handful of artists
+ISSUERS = 50
+REPEAT = 5
+
+# The part of shop.html that reads each listing
+TEMPLATE = """{% for n in nfts %}
+<p>{{n["owner"]}} is selling token {{n["id"]}} for {{'%0.2f'| format(drops_to_xrp(n["offer"]['amount']))}}XRP.
+It was issued by {{n['issuer']}} and points to {{n['uri']}}. It has a serial of {{n['serial']}}.
+The creator gets {{ n['fee'] / 1000 }}% of any future sales.</p>
+{% endfor %}"""
+
+
+def dict_factory(**kwargs):
+    return kwargs
+
+
+def rows():
+    random.seed(0)
+    issuers = [random.randbytes(20) for _ in range(ISSUERS)]
+    for i in range(LISTINGS):
+        issuer = random.choice(issuers)
+        fee = random.randrange(50000)
+        taxon, serial = random.randrange(2**32), i
+        token_id = f"0008{fee:04X}{issuer.hex().upper()}{taxon:08X}{serial:08X}"
+        owner = f"r{random.randbytes(12).hex()}"
+        yield {
+            "issuer": encode_classic_address(issuer),
+            "id": token_id,
+            "fee": fee,
+            "uri": f"ipfs://{random.randbytes(23).hex()}",
+            "serial": serial,
+            "owner": owner,
+            "offer": {
+                "nft_offer_index": random.randbytes(32).hex().upper(),
+                "owner": owner,
+                "amount": str(random.randrange(1, 10**9)),
+                "flags": 1,
+            },
+        }
+
+
+def build(factory, data):
+    return [factory(**row) for row in data]
+
+
+def held(factory, data):
+    gc.collect()
+    tracemalloc.start()
+    listings = build(factory, data)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del listings
+    return size
+
+
+if __name__ == "__main__":
+    data = list(rows())
+    template = Environment().from_string(TEMPLATE)
+    print(f"{LISTINGS} listings")
+    for name, factory in (("dict", dict_factory), ("NFTListing", NFTListing)):
+        size = held(factory, data)
+        built = timeit.timeit(lambda: build(factory, data), number=REPEAT) / REPEAT
+        listings = build(factory, data)
+        rendered = (
+            timeit.timeit(
+                lambda: template.render(nfts=listings, drops_to_xrp=drops_to_xrp),
+                number=REPEAT,
+            )
+            / REPEAT
+        )
+        print(
+            f"  {name:12} {size / LISTINGS:7.1f} bytes each"
+            f"  build {1000 * built:7.1f} ms  render {1000 * rendered:7.1f} ms"
+        )
@@ -0,0 +1,119 @@
+"""
+Streams a file from /nft/media/ to concurrent players making range requests:
+checking the wallet on every request, through `nft_required`'s decision
+cache, and with a media grant.
+
+The wallet lookup is simulated with a `LOOKUP_DELAY` sleep, about what a
+cached `has_nft` costs when the cache is another process away; with a cold
+cache it's a ledger round trip. Runs on werkzeug's threaded development
+server, so it measures the gate rather than sendfile.
+
+    python test/media_benchmark.py
+"""
+import http.client
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+from flask_login import LoginManager, UserMixin
+from werkzeug.serving import make_server
+
+from flask_nft_xumm import decorators
+from flask_nft_xumm.nft import GRANT_COOKIE, nft
+
+NFT_ID = "00080000" + "AB" * 28
+FILE_SIZE = 8 * 1024 * 1024
+CHUNK = 256 * 1024
+STREAMS = 16
+LOOKUP_DELAY = 0.02
+
+
+class Wallet:
+    address = "rListener"
+
+    def nfts_version(self):
+        return "1"
+
+    def has_nft(self, uri=None, hexed_uri=None, id=None):
+        time.sleep(LOOKUP_DELAY)
+        return id == NFT_ID
+
+
+class User(UserMixin):
+    id = "listener"
+    wallet = Wallet()
+
+
+def make_app(media_path):
+    app = Flask(__name__)
+    app.secret_key = "benchmark"
+    app.creds = {"media": {"path": media_path}}
+    app.register_blueprint(nft, url_prefix="/nft")
+    login_manager = LoginManager(app)
+    login_manager.request_loader(lambda request: User())
+    return app
+
+
+def stream(port, use_grant):
+    """Fetch the whole file in CHUNK sized ranges over one connection,
+    returning how long each request took."""
+    con = http.client.HTTPConnection("127.0.0.1", port)
+    path = f"/nft/media/{NFT_ID}/track.flac"
+    headers = {}
+    timings = []
+    for start in range(0, FILE_SIZE, CHUNK):
+        headers["Range"] = f"bytes={start}-{start + CHUNK - 1}"
+        sent = time.perf_counter()
+        con.request("GET", path, headers=headers)
+        response = con.getresponse()
+        assert response.status == 206, response.status
+        response.read()
+        timings.append(time.perf_counter() - sent)
+        if use_grant and "Cookie" not in headers:
+            grant = response.getheader("X-Media-Grant")
+            headers["Cookie"] = f"{GRANT_COOKIE}={grant}"
+    con.close()
+    return timings
+
+
+def bench(port, label, use_grant):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=STREAMS) as pool:
+        timings = sorted(
+            t
+            for ts in pool.map(lambda _: stream(port, use_grant), range(STREAMS))
+            for t in ts
+        )
+    elapsed = time.perf_counter() - started
+    megabytes = STREAMS * FILE_SIZE / 1024 / 1024
+    print(
+        f"  {label:22} {elapsed:6.2f} s  {len(timings) / elapsed:7.1f} req/s"
+        f"  {megabytes / elapsed:7.1f} MB/s"
+        f"  p50 {1000 * timings[len(timings) // 2]:6.1f} ms"
+        f"  p95 {1000 * timings[int(len(timings) * 0.95)]:6.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, NFT_ID))
+        with open(os.path.join(tmp, NFT_ID, "track.flac"), "wb") as f:
+            f.write(os.urandom(FILE_SIZE))
+        server = make_server("127.0.0.1", 0, make_app(tmp), threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(
+            f"{STREAMS} streams of {FILE_SIZE // 1024 // 1024} MB "
+            f"in {CHUNK // 1024} KB ranges"
+        )
+        allow_ttl, decorators.ALLOW_TTL = decorators.ALLOW_TTL, 0
+        bench(server.port, "wallet check each time", use_grant=False)
+        decorators.ALLOW_TTL = allow_ttl
+        bench(server.port, "decision cache", use_grant=False)
+        decorators.access_decisions.clear()
+        bench(server.port, "media grant", use_grant=True)
+        server.shutdown()
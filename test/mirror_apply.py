@@ -0,0 +1,137 @@
+"""
+Feeds `LedgerMirror.apply` canned stream messages for a mint, a sell offer
+being created and accepted, and another being cancelled, checking what the
+mirror makes of each, and that only tokens it seeded or saw minted are
+read from it rather than the ledger.
+
+    python test/mirror_apply.py
+"""
+import os
+import tempfile
+
+os.environ.setdefault("XUMM_DB_PATH", os.path.join(tempfile.mkdtemp(), "xumm.db"))
+os.environ.setdefault("XUMM_CACHE_PATH", os.path.join(tempfile.mkdtemp(), "cache.db"))
+
+from xrpl.core.addresscodec import decode_classic_address
+
+from flask_nft_xumm import db
+from flask_nft_xumm.migrations import migrate
+from flask_nft_xumm.mirror import LedgerMirror
+
+SELLER = "rPEPPER7kfTD9w2To4CQk6UCfuHM9c6GDY"
+BUYER = "rHb9CJAWyB4rj91VRWn96DkukG4bwdtyTh"
+NFT_ID = "00080000" + decode_classic_address(SELLER).hex().upper() + "0000099B00000000"
+UNSEEDED = NFT_ID[:-1] + "1"
+OFFER = "AB" * 32
+OTHER_OFFER = "CD" * 32
+
+
+def page_index(account):
+    # The first 20 bytes of an NFTokenPage's index are its owner's account id
+    return decode_classic_address(account).hex().upper() + "FF" * 12
+
+
+def message(transaction_type, account, nodes, ledger_index):
+    return {
+        "type": "transaction",
+        "validated": True,
+        "ledger_index": ledger_index,
+        "transaction": {
+            "TransactionType": transaction_type,
+            "Account": account,
+            "hash": f"{ledger_index:064X}",
+        },
+        "meta": {"TransactionResult": "tesSUCCESS", "AffectedNodes": nodes},
+    }
+
+
+def tokens(token_ids):
+    return [{"NFToken": {"NFTokenID": i, "URI": "AB"}} for i in token_ids]
+
+
+def token_page(account, kind, before, after):
+    return {
+        kind: {
+            "LedgerEntryType": "NFTokenPage",
+            "LedgerIndex": page_index(account),
+            "FinalFields": {"NFTokens": tokens(after)},
+            "PreviousFields": {"NFTokens": tokens(before)},
+        }
+    }
+
+
+def sell_offer(kind, offer_id, amount="1000000"):
+    fields = {"NFTokenID": NFT_ID, "Owner": SELLER, "Amount": amount, "Flags": 1}
+    return {
+        kind: {
+            "LedgerEntryType": "NFTokenOffer",
+            "LedgerIndex": offer_id,
+            ("NewFields" if kind == "CreatedNode" else "FinalFields"): fields,
+        }
+    }
+
+
+def offers():
+    return [o["nft_offer_index"] for o in db.mirror_sell_offers([NFT_ID])[NFT_ID]]
+
+
+def check(label, condition):
+    print(f"  {'ok' if condition else 'FAILED'}: {label}")
+    assert condition, label
+
+
+if __name__ == "__main__":
+    migrate(db.connection())
+    mirror = LedgerMirror()
+    mirror.watched.update({SELLER, BUYER})
+    mirror.ready.set()
+    db.mirror_replace_owned(SELLER, [(UNSEEDED, None)])
+
+    mirror.apply(
+        message(
+            "NFTokenMint",
+            SELLER,
+            [token_page(SELLER, "ModifiedNode", [UNSEEDED], [UNSEEDED, NFT_ID])],
+            1,
+        )
+    )
+    check("minted token is owned by the seller", db.mirror_owner(NFT_ID) == SELLER)
+    check("minted token is covered", mirror.covers(NFT_ID))
+    check("token held before subscribing isn't", not mirror.covers(UNSEEDED))
+
+    mirror.apply(
+        message("NFTokenCreateOffer", SELLER, [sell_offer("CreatedNode", OFFER)], 2)
+    )
+    check("created offer is listed", offers() == [OFFER])
+
+    mirror.apply(
+        message(
+            "NFTokenCreateOffer", SELLER, [sell_offer("CreatedNode", OTHER_OFFER)], 3
+        )
+    )
+    mirror.apply(
+        message(
+            "NFTokenCancelOffer", SELLER, [sell_offer("DeletedNode", OTHER_OFFER)], 4
+        )
+    )
+    check("cancelled offer is gone", offers() == [OFFER])
+
+    mirror.apply(
+        message(
+            "NFTokenAcceptOffer",
+            BUYER,
+            [
+                sell_offer("DeletedNode", OFFER),
+                token_page(SELLER, "ModifiedNode", [UNSEEDED, NFT_ID], [UNSEEDED]),
+                token_page(BUYER, "ModifiedNode", [], [NFT_ID]),
+            ],
+            5,
+        )
+    )
+    check("accepted offer is gone", offers() == [])
+    check("token belongs to the buyer", db.mirror_owner(NFT_ID) == BUYER)
+
+    failed = dict(message("NFTokenCreateOffer", SELLER, [], 6))
+    failed["meta"] = dict(failed["meta"], TransactionResult="tecNO_ENTRY")
+    check("failed transaction changes nothing", not mirror.apply(failed))
+    check("applied five transactions", mirror.applied == 5)
@@ -0,0 +1,97 @@
+"""
+Times the stock reads the app makes (through `db`, as the shop, wallet and
+cancel pages call them) against 100k listings, with and without the stock
+indexes.
+
+    python test/stock_benchmark.py
+"""
+import os
+import random
+import tempfile
+import timeit
+from pathlib import Path
+
+LISTINGS = 100_000
+SELLERS = 1_000
+ISSUERS = 100
+REPEAT = 50
+
+STOCK_INDEXES = [
+    "stock_signed",
+    "stock_signed_seller",
+    "stock_signed_issuer",
+    "stock_pending",
+]
+
+
+def calls(db):
+    return {
+        "shop": lambda: db.stock_page(),
+        "shop, page 4000": lambda: db.stock_page(after=80_000),
+        "shop/<seller>": lambda: db.stock_page(seller="seller-17"),
+        "shop?token_issuer": lambda: db.stock_page(issuer="issuer-3"),
+        "shop?min_price": lambda: db.stock_page(min_price=990_000_000),
+        "wallet": lambda: db.stock_signed(seller="seller-503"),
+        "cancel": lambda: db.stock_delete_offer("offer-77777"),
+    }
+
+
+def populate(con):
+    rows = [
+        (
+            f"{i:064X}",
+            f"offer-{i}",
+            int(random.random() < 0.9),
+            f"seller-{i % SELLERS}",
+            f"issuer-{random.randrange(ISSUERS)}",
+            random.randrange(50000),
+            random.randrange(1, 10**9),
+            i,
+        )
+        for i in range(LISTINGS)
+    ]
+    with con:
+        con.executemany(
+            "insert into stock (token_id, sale_offer, signed, seller, issuer, "
+            "transfer_fee, price, serial) values (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+
+def bench(db, con, label):
+    print(label)
+    for name, call in calls(db).items():
+        # The statement the call ran, with its parameters filled in
+        statements = []
+        con.set_trace_callback(statements.append)
+        call()
+        con.set_trace_callback(None)
+        (sql,) = [s for s in statements if s.split()[0] in ("select", "delete")]
+        plan = " / ".join(r[-1] for r in con.execute(f"explain query plan {sql}"))
+        t = timeit.timeit(call, number=REPEAT)
+        print(f"  {name:18} {1000 * t / REPEAT:8.3f} ms  {plan}")
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["XUMM_DB_PATH"] = str(Path(tmp) / "bench.db")
+        from flask_nft_xumm import db
+        from flask_nft_xumm.migrations import MIGRATIONS, migrate
+
+        con = db.connection()
+        migrate(con)
+        populate(con)
+        bench(db, con, f"{LISTINGS} listings, schema version {len(MIGRATIONS)}")
+        with con:
+            for index in STOCK_INDEXES:
+                con.execute(f"drop index {index}")
+        # A fresh connection, so no statement is still prepared against them
+        db.close()
+        con = db.connection()
+        bench(
+            db,
+            con,
+            f"{LISTINGS} listings, without the {', '.join(STOCK_INDEXES)} indexes",
+        )
+        db.close()